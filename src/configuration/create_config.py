@@ -33,6 +33,9 @@ def init_argparse() -> ArgumentParser:
 
     parser.add_argument("-rn", "--random_neighbor")
 
+    # wire format of the synchronisation messages: json or binary
+    parser.add_argument("-co", "--codec", default="json", choices=["json", "binary"])
+
     return parser
 
 
@@ -76,6 +79,7 @@ def main():
                 "synchronization_model": args.type,
                 "neighbors": "-".join(narr),
                 "time": args.time,
+                "codec": args.codec,
             }
 
             if args.type == "kuramoto":
@@ -138,11 +138,15 @@ def create_ini():
         input("How long do u want the synchronization process to run? (in seconds): ")
     )
 
+    codec = input("Which codec for synchronisation messages? (1) json (2) binary: ")
+
     cmd_line = [
         "python",
         "create_config.py",
         "-ti",
         f"{time}",
+        "-co",
+        "binary" if codec == "2" else "json",
     ]
 
     if synchro_type != 4:
@@ -1,86 +1,389 @@
 import json
 import os
 import asyncio
+import struct
 from configparser import ConfigParser
 from random import randint
-from time import sleep
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+# number of nodes hosted by one node process (pod), has to match NODES_PER_PROCESS of the nodes
+NODES_PER_PROCESS: int = int(os.environ.get("NODES_PER_PROCESS", 1))
+
+# number of node slots: replicas of the node StatefulSet * NODES_PER_PROCESS
+POOL_SIZE: int = int(os.environ.get("NODE_POOL_SIZE", 250))
+
+# messages to the nodes in flight at the same time
+MAX_IN_FLIGHT: int = 64
+
+# seconds to wait for the answer of a node
+TIMEOUT: float = 10
+
+# seconds between sending the start time and the start, enough to reach all nodes.
+# The nodes have to acknowledge the start time in the first half of the delay,
+# the second half is left to cancel the start on all nodes otherwise.
+START_DELAY: float = 2
+
+# tries to deliver a config or share_state to a node and to agree on a start time before a run is aborted
+ATTEMPTS: int = 3
+
+# query port of the logstorage and its framing, see logstorage/server.py
+LOGSTORAGE: Tuple[str, int] = ("logstorage", 50001)
+HEADER = struct.Struct("!IIB")
+QUERY_HEADER = struct.Struct("!I")
+REQUEST: int = 1
+
+# seconds between two status queries while waiting for the logs of a run
+POLL_INTERVAL: float = 1
+
+# seconds to wait for the logs of all nodes after the end of a run
+COMPLETION_TIMEOUT: float = 120
 
 
 def read_files() -> list:
     return [f for f in os.listdir(".") if "_" in f]
 
 
-async def send_message(message, to):
-    _, writer = await asyncio.open_connection(
-        f"node-{to}.stsservice.ma-schuetz-dcun.svc.cluster.local", 50000
+async def send_message(message: dict, to: int) -> dict:
+    """Send a message to the node in slot "to" and wait until the node closes the connection
+
+    Returns:
+        the answer of the node, None if it did not answer
+    """
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(
+            f"node-{to // NODES_PER_PROCESS}.stsservice.ma-schuetz-dcun.svc.cluster.local",
+            50000,
+        ),
+        TIMEOUT,
     )
-    writer.write(message.encode())
-    await writer.drain()
-    writer.close()
-    await writer.wait_closed()
+    try:
+        writer.write(json.dumps(message).encode())
+        await writer.drain()
+        writer.write_eof()  # the node reads the message until the end of the stream
 
+        data = await asyncio.wait_for(reader.read(), TIMEOUT)
+    finally:
+        writer.close()
+        await writer.wait_closed()
 
-async def main():
-    configparser = ConfigParser()
-    conf_files = read_files()
+    return json.loads(data) if data else None
+
+
+async def send_to_all(
+    messages: Dict[str, dict],
+    offset: int,
+    semaphore: asyncio.Semaphore,
+    ack: bool = False,
+) -> List[str]:
+    """Send the messages concurrently, at most MAX_IN_FLIGHT at a time
+
+    Args:
+        messages: node id: message
+        offset: slot of node 0 of the run
+        ack: the nodes have to acknowledge the message
+
+    Returns:
+        ids of the nodes that did not get the message or did not acknowledge it
+    """
+
+    async def send(node_id: str, message: dict) -> bool:
+        async with semaphore:
+            try:
+                answer = await send_message(message, int(node_id) + offset)
+            except (asyncio.TimeoutError, ConnectionError, OSError, ValueError):
+                return False
+        return not ack or (answer is not None and answer.get("operation") == "ack")
+
+    results = await asyncio.gather(*(send(n, m) for n, m in messages.items()))
+    return [n for n, sent in zip(messages, results) if not sent]
 
-    print(f"found files: {conf_files}")
 
-    while conf_files:
+async def deliver(
+    messages: Dict[str, dict], offset: int, semaphore: asyncio.Semaphore
+) -> List[str]:
+    """Send messages that have to be acknowledged, re-send them to the nodes that did not acknowledge them
+
+    Returns:
+        ids of the nodes that did not acknowledge their message after ATTEMPTS tries
+    """
+    failed = list(messages)
+    for _ in range(ATTEMPTS):
+        failed = await send_to_all(
+            {n: messages[n] for n in failed}, offset, semaphore, ack=True
+        )
+        if not failed:
+            break
+    return failed
+
+
+async def start(
+    run_id: str,
+    nodes: List[str],
+    offset: int,
+    semaphore: asyncio.Semaphore,
+    duration: float,
+) -> Optional[float]:
+    """Agree on a start time with all nodes of the run
+
+    A node acknowledges the start time only if it got it before that time and then starts on its own.
+    If not every node acknowledged it within the first half of the delay,
+    the start is cancelled on all nodes and tried again with twice the delay.
+    Nodes that could not be cancelled any more run for "duration" seconds, so their slots are kept until then.
+
+    Returns:
+        the start time, None if the nodes did not agree on one after ATTEMPTS tries
+        or the start could not be cancelled on every node
+    """
+    delay = START_DELAY
+    for _ in range(ATTEMPTS):
+        start_at = time() + delay
+        messages = {
+            node_id: {
+                "type": "synchronization",
+                "operation": "start",
+                "node_id": node_id,
+                "node_offset": offset,
+                "start_at": start_at,
+            }
+            for node_id in nodes
+        }
         try:
-            conf: str = conf_files.pop()
-        except IndexError:
-            print("DONE")
+            failed = await asyncio.wait_for(
+                send_to_all(messages, offset, semaphore, ack=True), delay / 2
+            )
+        except asyncio.TimeoutError:
+            failed = nodes
+        if not failed:
+            return start_at
+
+        print(f"\t{run_id}: not every node acknowledged the start in time, cancel it")
+        cancel = {
+            node_id: {
+                "type": "synchronization",
+                "operation": "cancel_start",
+                "node_id": node_id,
+                "node_offset": offset,
+            }
+            for node_id in nodes
+        }
+        started = await send_to_all(cancel, offset, semaphore, ack=True)
+        if started:
+            print(f"\t{run_id}: could not cancel the start of nodes {started}")
+            await asyncio.sleep(max(0, start_at - time()) + duration)
+            return None
+        delay *= 2
+
+    return None
+
+
+async def query_logstorage(request: dict) -> dict:
+    """Send a json query to the logstorage and return the json header of the result
+
+    Raises:
+        KeyError: if the logstorage could not answer the query
+    """
+    payload = json.dumps(request).encode()
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(*LOGSTORAGE), TIMEOUT
+    )
+    try:
+        writer.write(HEADER.pack(len(payload), 1, REQUEST) + payload)
+        await writer.drain()
+
+        length, _, _ = HEADER.unpack(
+            await asyncio.wait_for(reader.readexactly(HEADER.size), TIMEOUT)
+        )
+        data = await asyncio.wait_for(reader.readexactly(length), TIMEOUT)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+    (header_length,) = QUERY_HEADER.unpack_from(data)
+    header = json.loads(data[QUERY_HEADER.size : QUERY_HEADER.size + header_length])
+    if "error" in header:
+        raise KeyError(header["error"])
+    return header
+
+
+async def wait_for_completion(run_id: str, nodes: List[str]) -> List[str]:
+    """Wait until the logstorage stored the logs of all nodes of the run,
+    the logs of an earlier run with the same id are cleared before the run starts
+
+    Returns:
+        ids of the nodes whose logs are not complete after COMPLETION_TIMEOUT seconds
+    """
+    deadline = time() + COMPLETION_TIMEOUT
+    missing = list(nodes)
+
+    while True:
+        try:
+            status = await query_logstorage({"op": "status", "run_id": run_id})
+            complete = {str(n) for n in status["complete"]}
+            missing = [n for n in nodes if n not in complete]
+        except (asyncio.TimeoutError, ConnectionError, OSError, KeyError) as e:
+            print(f"\tlogstorage status failed: {e!r}")
+
+        if not missing or time() > deadline:
+            return missing
+
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+class NodePool:
+    """Hands out disjoint blocks of slots of the node pool, so several runs share the StatefulSet.
+
+    Slot s is hosted by the node process s // NODES_PER_PROCESS.
+    Blocks start at a process boundary, so two runs never share a process,
+    and node n of a run lives in the slot offset + n of its block.
+    """
+
+    def __init__(self, size: int = POOL_SIZE):
+        self.size = size
+        self.free: List[Tuple[int, int]] = [(0, size)]  # sorted (first, end) ranges
+
+    def block_size(self, nodes: int) -> int:
+        return -(-nodes // NODES_PER_PROCESS) * NODES_PER_PROCESS
+
+    def allocate(self, nodes: int) -> Optional[int]:
+        """Reserve the first free block for a run with the given number of nodes
+
+        Returns:
+            the offset of the block, None if no free block is large enough
+        """
+        size = self.block_size(nodes)
+        for i, (first, end) in enumerate(self.free):
+            if end - first >= size:
+                self.free[i] = (first + size, end)
+                self.free = [(f, e) for f, e in self.free if f < e]
+                return first
+        return None
+
+    def release(self, offset: int, nodes: int) -> None:
+        self.free.append((offset, offset + self.block_size(nodes)))
+        self.free.sort()
+
+        merged = [self.free[0]]
+        for first, end in self.free[1:]:
+            if first <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((first, end))
+        self.free = merged
+
+
+async def run(
+    conf: str, configparser: ConfigParser, offset: int, semaphore: asyncio.Semaphore
+) -> None:
+    """Run one config on the slots offset ... offset + number of nodes - 1 of the node pool"""
+    run_id = conf[:-4]
+    nodes = configparser.sections()
+    print(f"start: {run_id} on slots {offset} - {offset + len(nodes) - 1}")
+
+    # logs of an earlier run with the same id would count as complete and make the new batches duplicates
+    try:
+        await query_logstorage({"op": "clear", "run_id": run_id})
+    except (asyncio.TimeoutError, ConnectionError, OSError, KeyError) as e:
+        print(f"abort: {run_id}, could not clear the earlier logs: {e!r}")
+        return
+
+    configs = {}
+    for node_id in nodes:
+        node_section = configparser[node_id]
+
+        msg_dict = {
+            "type": "node",
+            "operation": "config",
+            "run": run_id,
+            "node_offset": offset,
+        }
+
+        msg_dict.update({k: v for k, v in node_section.items() if k not in ["graph"]})
+        configs[node_id] = msg_dict
+
+    failed = await deliver(configs, offset, semaphore)
+    if failed:
+        print(f"abort: {run_id}, no config ack from nodes {failed}")
+        return
+
+    # Share initial state for metro and potts, the nodes acknowledge before they broadcast it
+    if configparser["0"]["synchronization_model"] in ["mypotts", "metropolis"]:
+        print(f"\t{run_id}: share state")
+        failed = await deliver(
+            {
+                node_id: {
+                    "type": "synchronization",
+                    "operation": "share_state",
+                    "node_id": node_id,
+                    "node_offset": offset,
+                }
+                for node_id in nodes
+            },
+            offset,
+            semaphore,
+        )
+        if failed:
+            print(f"abort: {run_id}, share state failed for nodes {failed}")
             return
 
+    # Start: every node acknowledges the start time and starts on its own at that time
+    time_for_run = float(configparser["0"]["time"])
+    print(f"\t{run_id}: start")
+    start_at = await start(run_id, nodes, offset, semaphore, time_for_run)
+    if start_at is None:
+        print(f"abort: {run_id}, the nodes did not agree on a start time")
+        return
+
+    await asyncio.sleep(max(0, start_at - time()) + time_for_run)
+
+    # the slots are free again as soon as the logs of this run are stored
+    stragglers = await wait_for_completion(run_id, nodes)
+    if stragglers:
+        print(f"\t{run_id}: incomplete logs of nodes {stragglers}")
+    print(f"done: {run_id} after {time() - start_at:.1f} seconds")
+
+
+async def main():
+    semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+    pool = NodePool()
+
+    queue: List[Tuple[str, ConfigParser]] = []
+    for conf in read_files():
+        configparser = ConfigParser()
         configparser.read(conf)
-        run_id = conf[:-4]
-        print(f"start: {run_id}")
+        # a run takes whole processes, so its block can be larger than its number of nodes
+        if pool.block_size(len(configparser.sections())) > pool.size:
+            print(f"skip {conf}: needs more than the {pool.size} slots of the pool")
+            continue
+        queue.append((conf, configparser))
 
-        print("\tconfig")
-        for node_id in configparser.sections():
-            node_section = configparser[node_id]
+    print(f"found files: {[conf for conf, _ in queue]}")
 
-            msg_dict = {
-                "type": "node",
-                "operation": "config",
-                "run": run_id,
-            }
+    # run task: (offset, number of nodes)
+    running: Dict[asyncio.Task, Tuple[int, int]] = {}
+    while queue or running:
+        # start every queued config that fits into the free slots, in order of the queue
+        for conf, configparser in list(queue):
+            nodes = len(configparser.sections())
+            offset = pool.allocate(nodes)
+            if offset is None:
+                continue
 
-            msg_dict.update(
-                {k: v for k, v in node_section.items() if k not in ["graph"]}
-            )
+            queue.remove((conf, configparser))
+            task = asyncio.create_task(run(conf, configparser, offset, semaphore))
+            running[task] = (offset, nodes)
+
+        if not running:
+            # nothing runs, so the whole pool is free and the rest of the queue can never start
+            print(f"skip {[conf for conf, _ in queue]}: no free block of the pool fits")
+            break
 
-            await send_message(json.dumps(msg_dict), node_id)
-
-        # Share initial state for metro and potts
-        if configparser["0"]["synchronization_model"] in ["mypotts", "metropolis"]:
-            sleep(2)
-            print("\tshare state")
-            for node_id in configparser.sections():
-                msg = json.dumps(
-                    {"type": "synchronization", "operation": "share_state"}
-                )
-                await send_message(msg, node_id)
-                sleep(0.05)
-
-        # Wait before start
-        if configparser["0"]["synchronization_model"] in ["mypotts", "metropolis"]:
-            sleep(5)
-        else:
-            sleep(2)
-
-        # Start
-        print("\tstart")
-        for node_id in configparser.sections():
-            msg = json.dumps({"type": "synchronization", "operation": "start"})
-            await send_message(msg, node_id)
-
-        time_for_run = float(configparser["0"]["time"])
-
-        total_wait_time: float = time_for_run + (len(configparser.sections()) / 4.5) + 5
-        print(f"\twaiting {total_wait_time} seconds")
-        sleep(total_wait_time)
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            pool.release(*running.pop(task))
+            if task.exception() is not None:
+                print(f"run failed: {task.exception()!r}")
 
 
 if __name__ == "__main__":
@@ -1,14 +1,229 @@
 import os, json
+import socket
+import struct
 from statistics import mean
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 import networkx as nx
 import networkx.algorithms.community as nx_comm
+import numpy as np
+import pandas as pd
+
+# port of the query api of the logstorage, e.g. after
+# kubectl port-forward logstorage 50001:50001 -n ma-schuetz-dcun
+QUERY_PORT: int = 50001
+
+# frame header of the logstorage: payload length, correlation id, flags
+# has to match HEADER in logstorage/server.py
+HEADER = struct.Struct("!IIB")
+REQUEST: int = 1
+
+# query results start with the length of their json header
+QUERY_HEADER = struct.Struct("!I")
+
+# node: times and values of the logged samples of the node, see load_run()
+Series = Dict[str, Tuple[np.ndarray, np.ndarray]]
 
 
 def read_csvs():
     return [f for f in os.listdir("./detect/") if ".csv" in f]
 
 
+def load_run(path: str, max_time: float = None, cache: bool = True) -> Series:
+    """
+    read the samples of every node of a run csv
+
+    The csv is parsed once: the samples of all nodes are stored one node after another
+    in one time and one value array, the arrays of a node are views into them.
+    With "cache" these arrays are saved next to the csv (run.csv -> run.npz)
+    and later loads read them instead of parsing the csv again, as long as the csv is not newer.
+
+    Args:
+        path: path of the csv
+        max_time: drop samples after this time, keep all if None
+
+    Returns:
+        node: (times, values) without the empty cells of the node
+    """
+    npz = f"{os.path.splitext(path)[0]}.npz"
+
+    if (
+        cache
+        and os.path.exists(npz)
+        and os.path.getmtime(npz) >= os.path.getmtime(path)
+    ):
+        with np.load(npz) as data:
+            nodes, times, values, offsets = (
+                data["nodes"],
+                data["times"],
+                data["values"],
+                data["offsets"],
+            )
+    else:
+        nodes, times, values, offsets = parse_run_csv(path)
+        if cache:
+            with open(f"{npz}.tmp", "wb") as f:
+                np.savez(f, nodes=nodes, times=times, values=values, offsets=offsets)
+            os.replace(f"{npz}.tmp", npz)
+
+    return split_series(nodes, times, values, offsets, max_time)
+
+
+def parse_run_csv(
+    path: str,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    parse a wide run csv (a collumn time and a collumn per node) into flat arrays
+
+    Returns:
+        the node names, the times and values of all nodes one after another
+        and the offsets of the nodes in them (len(nodes) + 1 entries)
+    """
+    df = pd.read_csv(path).sort_values("time", kind="stable")
+    time = df["time"].to_numpy(dtype=np.float64)
+    nodes = [c for c in df.columns if c != "time"]
+    matrix = df[nodes].to_numpy(dtype=np.float64)
+
+    logged = ~np.isnan(matrix)
+    counts = logged.sum(axis=0)
+
+    # column major: all samples of the first node, then all of the second, ...
+    times = np.broadcast_to(time[:, None], matrix.shape).T[logged.T]
+    values = matrix.T[logged.T]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    return np.array(nodes, dtype=str), times, values, offsets
+
+
+def split_series(
+    nodes: np.ndarray,
+    times: np.ndarray,
+    values: np.ndarray,
+    offsets: np.ndarray,
+    max_time: float = None,
+) -> Series:
+    """views of the samples of every node into the flat arrays, samples of a node are sorted by time"""
+    series: Series = {}
+    for node, first, end in zip(nodes, offsets[:-1], offsets[1:]):
+        t = times[first:end]
+        if max_time is not None:
+            end = first + np.searchsorted(t, max_time, side="right")
+        series[str(node)] = (times[first:end], values[first:end])
+    return series
+
+
+def read_csvs_from_logstorage(host: str, port: int = QUERY_PORT) -> List[str]:
+    """names of the runs that have an ini in ./detect/ and logs in the logstorage, as csv names like read_csvs()"""
+    inis = {f[:-4] for f in os.listdir("./detect/") if f.endswith(".ini")}
+    header, _ = query_logstorage({"op": "runs"}, host, port)
+    return [f"{run}.csv" for run in header["runs"] if run in inis]
+
+
+def read_run_from_logstorage(
+    run_id: str,
+    host: str,
+    port: int = QUERY_PORT,
+    nodes: List[int] = None,
+    begin: float = None,
+    end: float = None,
+) -> pd.DataFrame:
+    """
+    read a time window of a run directly from the logstorage instead of the exported csv
+
+    Args:
+        run_id: name of the run, the name of the config without ".ini"
+        host:   host of the logstorage
+        nodes:  ids of the nodes to read, all nodes if None
+        begin:  first time to read, from the start if None
+        end:    last time to read, until the end if None
+
+    Returns:
+        a dataframe like pd.read_csv of the exported csv: a collumn time and a collumn for every node
+    """
+    series = read_series_from_logstorage(run_id, host, port, nodes, begin, end)
+    columns = [
+        pd.Series(values, index=times, name=node)
+        for node, (times, values) in series.items()
+    ]
+
+    if not columns:
+        return pd.DataFrame(columns=["time"])
+
+    df = pd.concat(columns, axis=1).sort_index()
+    df.index.name = "time"
+    return df.reset_index()
+
+
+def read_series_from_logstorage(
+    run_id: str,
+    host: str,
+    port: int = QUERY_PORT,
+    nodes: List[int] = None,
+    begin: float = None,
+    end: float = None,
+) -> Series:
+    """
+    read a time window of a run from the logstorage like load_run() reads the csv
+
+    Args: see read_run_from_logstorage()
+
+    Returns:
+        node: (times, values), views into the received result
+    """
+    header, body = query_logstorage(
+        {"op": "query", "run_id": run_id, "nodes": nodes, "begin": begin, "end": end},
+        host,
+        port,
+    )
+
+    samples = np.frombuffer(body, dtype="<f8")
+    series: Series = {}
+    offset = 0
+    for node, count in zip(header["nodes"], header["counts"]):
+        times = samples[offset : offset + count]
+        values = samples[offset + count : offset + 2 * count]
+        offset += 2 * count
+        series[str(node)] = (times, values)
+
+    return series
+
+
+def query_logstorage(
+    request: dict, host: str, port: int = QUERY_PORT
+) -> Tuple[dict, bytes]:
+    """
+    send a query to the logstorage and wait for the result
+
+    Returns:
+        the json header and the raw body of the result
+
+    Raises:
+        KeyError: if the logstorage could not answer the query
+    """
+    payload = json.dumps(request).encode()
+
+    with socket.create_connection((host, port)) as sock:
+        sock.sendall(HEADER.pack(len(payload), 1, REQUEST) + payload)
+        length, _, _ = HEADER.unpack(receive_exactly(sock, HEADER.size))
+        data = receive_exactly(sock, length)
+
+    (header_length,) = QUERY_HEADER.unpack_from(data)
+    header = json.loads(data[QUERY_HEADER.size : QUERY_HEADER.size + header_length])
+    if "error" in header:
+        raise KeyError(header["error"])
+
+    return header, data[QUERY_HEADER.size + header_length :]
+
+
+def receive_exactly(sock: socket.socket, n: int) -> bytes:
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("logstorage closed the connection")
+        data += chunk
+    return bytes(data)
+
+
 def write_metrics_to_file(metrics: dict, config: str, overwrite: bool = False) -> None:
     try:
         with open(f"./gen/{config}.json", "x") as file:
@@ -19,14 +234,187 @@ def write_metrics_to_file(metrics: dict, config: str, overwrite: bool = False) -
                 file.write(json.dumps(metrics, indent=4))
 
 
-def create_metrics_for_node(G: nx.Graph, detection_results: dict) -> dict:
+def first_in_deviation(mean: float, value: float) -> Optional[float]:
+    """
+    smallest deviation d at which a neighbor with "value" is in the community: |mean - value| <= d * mean
+
+    Returns:
+        |mean - value| / mean, None if the neighbor is not in at any deviation (mean < 0)
+    """
+    diff = abs(mean - value)
+    if diff == 0 and mean >= 0:
+        return 0.0
+    if mean <= 0:
+        return None
+    return diff / mean
+
+
+def is_in(first_in: Optional[float], deviation: float) -> bool:
+    return first_in is not None and first_in <= deviation
+
+
+def detection_at(detection_results: dict, deviation: float) -> dict:
+    """
+    in and out lists of every source node at one deviation
+
+    Args:
+        detection_results:  first in deviation of every edge, format:
+                            {
+                                "1": {"2": 0.05, "3": 0.42, "4": None},
+                                "2": {...}
+                            }
+        deviation:          the deviation
+
+    Returns:
+        {
+            "1": {"in": ["2"], "out": ["3", "4"]},
+            "2": {...}
+        }
+    """
+    return {
+        source_node: {
+            "in": [n for n, first_in in targets.items() if is_in(first_in, deviation)],
+            "out": [
+                n for n, first_in in targets.items() if not is_in(first_in, deviation)
+            ],
+        }
+        for source_node, targets in detection_results.items()
+    }
+
+
+# a neighbor that is not in at any deviation, in the edge arrays of a detection
+NEVER_IN: float = np.inf
+
+
+def write_detection_to_file(
+    detection_results: dict, deviations: list, config: str, overwrite: bool = False
+) -> None:
+    """
+    write a detection to ./gen/{config}.npz as edge list, see read_detection_edges()
+
+    Args:
+        detection_results:  first in deviation of every edge, see detection_at()
+        deviations:         the deviations the detection is evaluated at
+        config:             name of the file without extension
+        overwrite:          replace an existing file, otherwise it is kept like in write_metrics_to_file()
+    """
+    source, target, first_in = detection_to_edges(detection_results)
+
+    try:
+        with open(f"./gen/{config}.npz", "wb" if overwrite else "xb") as file:
+            np.savez_compressed(
+                file,
+                source=source,
+                target=target,
+                first_in=first_in,
+                deviations=np.asarray(deviations, dtype=np.float64),
+            )
+    except FileExistsError:
+        pass
+
+
+def read_detection_edges(
+    path: str,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[float]]:
+    """
+    read a detection written by write_detection_to_file() or a _nodes.json of older versions
+
+    Returns:
+        source node, target node and first in deviation (NEVER_IN if never in) of every edge,
+        one array each, and the deviations the detection is evaluated at
+    """
+    if path.endswith(".json"):
+        detection_results, deviations = read_detection_json(path)
+        return (*detection_to_edges(detection_results), deviations)
+
+    with np.load(path) as data:
+        return (
+            data["source"],
+            data["target"],
+            data["first_in"],
+            data["deviations"].tolist(),
+        )
+
+
+def read_detection_file(path: str) -> Tuple[dict, list]:
+    """
+    Returns:
+        the first in deviation of every edge (see detection_at()) and the deviations of a detection file
+    """
+    source, target, first_in, deviations = read_detection_edges(path)
+    return edges_to_detection(source, target, first_in), deviations
+
+
+def read_detection_json(path: str) -> Tuple[dict, list]:
+    """
+    read a _nodes.json with first in deviations or with in and out lists for every deviation
+
+    In and out lists are converted to the smallest deviation at which a neighbor is in.
+    """
+    with open(path) as file:
+        detection = json.load(file)
+
+    if "first_in" in detection:
+        return detection["first_in"], detection["deviations"]
+
+    # {source: {deviation: {"in": [...], "out": [...]}}}
+    detection_results: dict = {}
+    deviations: set = set()
+    for source_node, dev_dict in detection.items():
+        detection_results[source_node] = {}
+        for deviation, in_out in dev_dict.items():
+            deviation = float(deviation)
+            deviations.add(deviation)
+
+            for target_node in in_out["out"]:
+                detection_results[source_node].setdefault(target_node, None)
+            for target_node in in_out["in"]:
+                first_in = detection_results[source_node].get(target_node)
+                if first_in is None or deviation < first_in:
+                    detection_results[source_node][target_node] = deviation
+
+    return detection_results, sorted(deviations)
+
+
+def detection_to_edges(
+    detection_results: dict,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """source nodes, target nodes and first in deviations of a detection, see read_detection_edges()"""
+    source = [s for s, targets in detection_results.items() for _ in targets]
+    target = [t for targets in detection_results.values() for t in targets]
+    first_in = [
+        NEVER_IN if f is None else f
+        for targets in detection_results.values()
+        for f in targets.values()
+    ]
+    return (
+        np.array(source, dtype=str),
+        np.array(target, dtype=str),
+        np.array(first_in, dtype=np.float64),
+    )
+
+
+def edges_to_detection(
+    source: np.ndarray, target: np.ndarray, first_in: np.ndarray
+) -> dict:
+    """first in deviation of every edge like detection_at() expects it, from the arrays of read_detection_edges()"""
+    detection_results: dict = {}
+    for s, t, f in zip(source.tolist(), target.tolist(), first_in.tolist()):
+        detection_results.setdefault(s, {})[t] = None if f == NEVER_IN else f
+    return detection_results
+
+
+def create_metrics_for_node(
+    G: nx.Graph, detection_results: dict, deviations: list
+) -> dict:
     """
     create metrics for a single node based on the communities detected by the Louvain Method
 
     Args:
         G:                  the graph of the network, used to get the neighbors of nodes
-        detection_results:  a dict containing the results of the community detection.
-                            For format see "detect_communities()"
+        detection_results:  a dict containing the first in deviation of every edge.
+                            For format see "detection_at()"
+        deviations:         the deviations to create the metrics for
 
     Returns:
 
@@ -82,28 +470,20 @@ def create_metrics_for_node(G: nx.Graph, detection_results: dict) -> dict:
                 source_node_results = detection_results[source_node]
 
                 # for deviation: count how many are right and wrong
-                for deviation in source_node_results:
+                for deviation in deviations:
                     count_detections[source_node][deviation] = {
                         "correct_in": 0,
                         "incorrect_in": 0,
                         "correct_out": 0,
                         "incorrect_out": 0,
                     }
-                    for target_node in detection_results[source_node][deviation]["in"]:
-
-                        if target_node in louvain_community:
-                            count_detections[source_node][deviation]["correct_in"] += 1
-                        else:
-                            count_detections[source_node][deviation][
-                                "incorrect_in"
-                            ] += 1
-                    for target_node in detection_results[source_node][deviation]["out"]:
-                        if target_node not in louvain_community:
-                            count_detections[source_node][deviation]["correct_out"] += 1
+                    for target_node, first_in in source_node_results.items():
+                        same_community = target_node in louvain_community
+                        if is_in(first_in, deviation):
+                            count = "correct_in" if same_community else "incorrect_in"
                         else:
-                            count_detections[source_node][deviation][
-                                "incorrect_out"
-                            ] += 1
+                            count = "incorrect_out" if same_community else "correct_out"
+                        count_detections[source_node][deviation][count] += 1
             except KeyError:
                 pass
 
@@ -1,22 +1,42 @@
 import multiprocessing
+from functools import lru_cache
 from statistics import mean
 from time import time
+from typing import Dict, List, Tuple
 from scipy.interpolate import InterpolatedUnivariateSpline
-import pandas as pd
 import numpy as np
 import networkx as nx
 from configparser import ConfigParser
 import signal
 
 from common_methods import (
+    Series,
+    load_run,
     read_csvs,
+    read_csvs_from_logstorage,
+    read_series_from_logstorage,
     write_metrics_to_file,
+    write_detection_to_file,
+    first_in_deviation,
+    detection_at,
     create_metrics_for_node,
     create_metrics_for_run,
 )
 
 # seconds when to start and when to end
 
+# seconds read before begin and after end, so the interpolation is defined over the whole window
+WINDOW_MARGIN: float = 1
+
+# points per second of the time grid the signal differences are integrated on
+STEPS_PER_SECOND: int = 15
+
+# relative deviations from the mean AUC the communities are evaluated at
+DEVIATIONS: List[float] = [
+    float("%.2f" % deviation)  # remove floating point error
+    for deviation in np.arange(0.1, 0.91, 0.1)
+]
+
 
 def main():
     begin: int = 5
@@ -24,11 +44,17 @@ def main():
     net_AUC: bool = False
     from_source: bool = True
     mutual_membership: bool = False
+    # host of the logstorage query api (e.g. "localhost" with kubectl port-forward),
+    # None reads the csv files in /evaluation/detect/
+    logstorage: str = None
 
     # create iterable with function args
     arguments = []
-    for csv in read_csvs():
-        arguments.append((csv, begin, end, net_AUC, from_source, mutual_membership))
+    csvs = read_csvs() if logstorage is None else read_csvs_from_logstorage(logstorage)
+    for csv in csvs:
+        arguments.append(
+            (csv, begin, end, net_AUC, from_source, mutual_membership, logstorage)
+        )
 
     if len(arguments) == 0:
         print(
@@ -58,13 +84,13 @@ def run_detection(
     net_AUC: bool = False,
     from_source: bool = True,
     mutual_membership: bool = False,
+    logstorage: str = None,
 ):
 
     cp = ConfigParser()
     config = csv[:-4]
     start = time()
 
-    df = pd.read_csv(f"./detect/{csv}")
     ini_file = f"{config}.ini"
     res = cp.read(f"./detect/{ini_file}")
 
@@ -82,29 +108,38 @@ def run_detection(
         G, lambda n: n[1:] if "n" in n else n
     )  # i graph names nodes n0, n1 etc: remove leading n
 
-    df = df.rename(index=lambda x: f"z{x}")
-    df = df[df.time <= max_time]
+    if logstorage is None:
+        series = load_run(f"./detect/{csv}", max_time)
+    else:  # only the window that is integrated
+        series = read_series_from_logstorage(
+            config,
+            logstorage,
+            begin=begin - WINDOW_MARGIN,
+            end=min(end + WINDOW_MARGIN, max_time),
+        )
 
     if from_source:
         aucs_source = calculate_AUCs_from_sourcenode(
-            G, df, begin, end, synchro_type, max_states, net_AUC
+            G, series, begin, end, synchro_type, max_states, net_AUC
         )
         detection, deviations = detect_communities_from_sourcenode(G, aucs_source)
     else:
-        aucs = calculate_AUCs(G, df, begin, end, net_AUC)
+        aucs = calculate_AUCs(G, series, begin, end, net_AUC)
         detection, deviations = detect_communities(G, aucs)
 
-    write_metrics_to_file(
-        detection,
-        f"{config}_nodes",
-    )
+    write_detection_to_file(detection, deviations, f"{config}_nodes")
 
     if mutual_membership:
+        # mutual_communitymembership moves nodes between the in and out lists of each deviation
+        at_deviation = {d: detection_at(detection, d) for d in deviations}
+        in_out = {
+            node: {d: at_deviation[d][node] for d in deviations} for node in detection
+        }
         for _ in range(10):
-            mutual_communitymembership(detection)
+            mutual_communitymembership(in_out)
 
     # metrics
-    # metrics_nodes = create_metrics_for_node(G, detection)
+    # metrics_nodes = create_metrics_for_node(G, detection, deviations)
     # metrics = create_metrics_for_run(metrics_nodes, deviations)
 
     # write_metrics_to_file(metrics_nodes, config, True, overwrite=False)
@@ -116,7 +151,7 @@ def run_detection(
 
 
 def calculate_AUCs(
-    G: nx.Graph, df: pd.DataFrame, begin: int, end: int, calculate_net: bool
+    G: nx.Graph, series: Series, begin: int, end: int, calculate_net: bool
 ):
     """calculate total AUCs and net AUCs (integral)"""
     # Calculate AUC for everynode s
@@ -125,186 +160,169 @@ def calculate_AUCs(
         node: str = str(node)
 
         try:
-            d: dict = {"time": df["time"], node: df[node]}
-            df_node: pd.DataFrame = pd.DataFrame.from_dict(d)
-            df_node = df_node.dropna()
-
-            if calculate_net:
-                vals = df_node[f"{node}"]
-            else:
-                vals = np.absolute(df_node[f"{node}"])  # AUC not integral
-
-            AUCs[node] = InterpolatedUnivariateSpline(
-                x=df_node["time"], y=vals
-            ).integral(begin, end)
+            times, vals = series[node]
+
+            if not calculate_net:
+                vals = np.absolute(vals)  # AUC not integral
+
+            AUCs[node] = InterpolatedUnivariateSpline(x=times, y=vals).integral(
+                begin, end
+            )
         except KeyError:
             print("node not found")
     return AUCs
 
 
-def calculate_AUCs_from_sourcenode(
-    G: nx.Graph,
-    df: pd.DataFrame,
-    begin: int,
-    end: int,
-    synchro_type: str,
-    max_states: int,
-    calculate_net: bool = False,
-):
-    """Calculates AUCs (total and net) of the signal difference between source and target nodes"""
+def resample_nodes(
+    G: nx.Graph, series: Series, time: np.ndarray, calculate_net: bool = False
+) -> Tuple[Dict[str, int], np.ndarray]:
+    """Interpolate the signal of every node onto the time grid
 
-    interpolated: dict = {}
+    Returns:
+        node: row and a matrix with the interpolated signal of one node per row
+    """
+    index: dict = {}
+    rows = []
 
     for node in G.nodes:  # interpolieren
         node: str = str(node)
 
         try:
-            d: dict = {"time": df["time"], node: df[node]}
-            df_node: pd.DataFrame = pd.DataFrame.from_dict(d)
-            df_node = df_node.dropna()
-
-            if calculate_net:
-                vals = df_node[f"{node}"]
-            else:
-                vals = np.absolute(df_node[f"{node}"])  # AUC not integral
-
-            interpolated[node] = InterpolatedUnivariateSpline(x=df_node["time"], y=vals)
+            times, vals = series[node]
         except KeyError:
             print(f"node {node} not found")
+            continue
 
-    steps_per_second = 15
-    time = np.linspace(begin, end, num=((end - begin) * steps_per_second))
+        if not calculate_net:
+            vals = np.absolute(vals)  # AUC not integral
 
-    AUCs: dict = {}  # nested dict: {source_node : { target_node : auc}}
-    for source_node in G.nodes:
-        try:
-            source_node: str = str(source_node)
-
-            AUCs[source_node] = {}
-            diff = []
-            for neighbor in G.neighbors(source_node):
-
-                if synchro_type == "kuramoto":
-                    diff = [
-                        interpolated[neighbor](t) - interpolated[source_node](t)
-                        for t in time
-                    ]
-                elif synchro_type in ["mypotts", "clock", "metropolis"]:
-                    diff = []
-                    for t in time:
-                        target = interpolated[neighbor](t)
-                        node = interpolated[source_node](t)
-                        if abs(target - node) < max_states / 2:
-                            diff.append((target - node))
-                        else:
-                            diff.append(max_states - int(node) - target)
-
-                    if not calculate_net:
-                        diff = [abs(d) for d in diff]
-
-                AUCs[source_node][neighbor] = InterpolatedUnivariateSpline(
-                    x=time, y=diff
-                ).integral(begin, end)
-
-                # plt.plot(time, diff)
-                # plt.show()
-        except KeyError:
-            pass
+        index[node] = len(rows)
+        rows.append(InterpolatedUnivariateSpline(x=times, y=vals)(time))
 
-    return AUCs
+    return index, np.array(rows).reshape(len(rows), len(time))
 
 
-def detect_communities(G: nx.Graph, AUCs: dict):
-    detection_results: dict = {}  # knoten: (detection_abweichung: (status: []))
-    deviations = []
-    for node in G.nodes:
-        try:
-            detection_results[node] = {}
-            # neighbor_aucs: dict = {n: AUCs[n] for n in G.neighbors(node)}
-
-            neighbor_aucs: dict = {}
-            for n in G.neighbors(node):
-                try:
-                    neighbor_aucs[n] = AUCs[n]
-                except KeyError:
-                    pass
-
-            # calculate AUC_mean
-            auc_mean: float = sum(list(neighbor_aucs.values())) / len(
-                list(neighbor_aucs.values())
-            )
+@lru_cache
+def spline_integral_weights(begin: float, end: float, num: int) -> np.ndarray:
+    """Weights w of the time grid with sum(w * y) = InterpolatedUnivariateSpline(time, y).integral(begin, end)
 
-            # check if same community
-            deviations = []
-            for detection_abweichung in np.arange(0.1, 0.91, 0.1):
-                detection_abweichung = float(
-                    "%.2f" % detection_abweichung
-                )  # remove floating point error
+    The interpolating spline is linear in y, so its integral is the same weighted sum for every y:
+    the weight of a grid point is the integral of the spline through 1 at that point and 0 elsewhere.
+    """
+    time = np.linspace(begin, end, num=num)
+    return np.array(
+        [
+            InterpolatedUnivariateSpline(x=time, y=unit).integral(begin, end)
+            for unit in np.eye(num)
+        ]
+    )
 
-                deviations.append(detection_abweichung)
 
-                detection_results[node][detection_abweichung] = {"in": [], "out": []}
-                # node y is in if: |A_mean − A_y| ≤ 0.1 ∗ A_mean
+def calculate_AUCs_from_sourcenode(
+    G: nx.Graph,
+    series: Series,
+    begin: int,
+    end: int,
+    synchro_type: str,
+    max_states: int,
+    calculate_net: bool = False,
+):
+    """Calculates AUCs (total and net) of the signal difference between source and target nodes
+
+    All nodes are interpolated onto one time grid, the differences of all edges are one matrix
+    and their AUCs one product with the integral weights of the grid.
+    Every edge is computed once for both directions.
+    """
+    time = np.linspace(begin, end, num=((end - begin) * STEPS_PER_SECOND))
+    index, signals = resample_nodes(G, series, time, calculate_net)
+
+    edges = [(s, t) for s, t in G.edges if s in index and t in index]
+    source = signals[[index[s] for s, _ in edges]].reshape(len(edges), len(time))
+    target = signals[[index[t] for _, t in edges]].reshape(len(edges), len(time))
+    diff = target - source
+
+    if synchro_type == "kuramoto":
+        forward = diff
+        backward = -diff
+    elif synchro_type in ["mypotts", "clock", "metropolis"]:
+        # the short way around the circle of states
+        wrap = np.abs(diff) >= max_states / 2
+        forward = np.where(wrap, max_states - np.trunc(source) - target, diff)
+        backward = np.where(wrap, max_states - np.trunc(target) - source, -diff)
+
+        if not calculate_net:
+            forward = np.abs(forward)
+            backward = np.abs(backward)
+    else:
+        raise ValueError(f"unknown synchronization model {synchro_type}")
 
-                for neighbor, auc in neighbor_aucs.items():
-                    # print(f"{neighbor}: {auc}")
+    weights = spline_integral_weights(begin, end, len(time))
+    edge_aucs: dict = {}  # (source_node, target_node): auc
+    for (s, t), auc_forward, auc_backward in zip(
+        edges, forward @ weights, backward @ weights
+    ):
+        edge_aucs[(s, t)] = float(auc_forward)
+        edge_aucs[(t, s)] = float(auc_backward)
 
-                    diff: float = abs(auc_mean - auc)
-                    # print(f"diff: {diff}")
-                    # print(f"should be in: {detection_abweichung * auc_mean}")
+    AUCs: dict = {}  # nested dict: {source_node : { target_node : auc}}
+    for source_node in G.nodes:
+        source_node: str = str(source_node)
+        if source_node not in index:
+            continue
 
-                    # abs around
-                    if abs(auc_mean - auc) <= detection_abweichung * auc_mean:
-                        detection_results[node][detection_abweichung]["in"].append(
-                            neighbor
-                        )
-                    else:
-                        detection_results[node][detection_abweichung]["out"].append(
-                            neighbor
-                        )
-        except KeyError:
-            pass
+        AUCs[source_node] = {
+            neighbor: edge_aucs[(source_node, neighbor)]
+            for neighbor in G.neighbors(source_node)
+            if neighbor in index
+        }
 
-    return detection_results, deviations
+    return AUCs
 
 
-def detect_communities_from_sourcenode(G: nx.Graph, Aucs: dict) -> tuple[dict, list]:
-    detection_results = {}
-    deviations: list = []
+def detect_communities(G: nx.Graph, AUCs: dict) -> tuple[dict, list]:
+    """compare the AUC of every neighbor with the mean AUC of the neighbors, see detect_communities_from_sourcenode()"""
+    detection_results: dict = {}  # knoten: {nachbar: first in deviation}
+    for node in G.nodes:
+        neighbor_aucs: dict = {}
+        for n in G.neighbors(node):
+            try:
+                neighbor_aucs[n] = AUCs[n]
+            except KeyError:
+                pass
 
-    for source_node in Aucs:
-        detection_results[source_node] = {}
-        aucs = list(Aucs[source_node].values())
+        # calculate AUC_mean
+        auc_mean: float = sum(neighbor_aucs.values()) / len(neighbor_aucs)
 
-        mean_auc = mean(aucs)
+        detection_results[node] = {
+            neighbor: first_in_deviation(auc_mean, auc)
+            for neighbor, auc in neighbor_aucs.items()
+        }
 
-        # check if same community
-        deviations = []
+    return detection_results, DEVIATIONS
 
-        for detection_abweichung in np.arange(0.1, 0.91, 0.1):
-            detection_abweichung = float(
-                "%.2f" % detection_abweichung
-            )  # remove floating point error
 
-            deviations.append(detection_abweichung)
+def detect_communities_from_sourcenode(G: nx.Graph, Aucs: dict) -> tuple[dict, list]:
+    """
+    node y is in the community of the source node at deviation d if: |A_mean − A_y| ≤ d ∗ A_mean
 
-            detection_results[source_node][detection_abweichung] = {"in": [], "out": []}
-            # node y is in if: |A_mean − A_y| ≤ 0.1 ∗ A_mean
+    Instead of in and out lists for every deviation only the smallest d at which a neighbor is in
+    is stored, see common_methods.first_in_deviation(), so the detection at any deviation
+    can be read from it (common_methods.detection_at()).
 
-            for neighbor, auc in Aucs[source_node].items():
-                # print(
-                #     f"{auc}: {abs(mean_auc - auc)} < {detection_abweichung * mean_auc}"
-                # )
-                if abs(mean_auc - auc) <= detection_abweichung * mean_auc:
-                    detection_results[source_node][detection_abweichung]["in"].append(
-                        neighbor
-                    )
-                else:
-                    detection_results[source_node][detection_abweichung]["out"].append(
-                        neighbor
-                    )
+    Returns:
+        {source_node: {neighbor: first in deviation}} and the list of the deviations to evaluate
+    """
+    detection_results = {}
+
+    for source_node in Aucs:
+        mean_auc = mean(Aucs[source_node].values())
+
+        detection_results[source_node] = {
+            neighbor: first_in_deviation(mean_auc, auc)
+            for neighbor, auc in Aucs[source_node].items()
+        }
 
-    return detection_results, deviations
+    return detection_results, DEVIATIONS
 
 
 def mutual_communitymembership(detections: dict):
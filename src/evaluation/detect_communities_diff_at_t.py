@@ -3,28 +3,39 @@ from math import pi
 import multiprocessing
 import subprocess
 from time import time
-from scipy.interpolate import InterpolatedUnivariateSpline
-import pandas as pd
 import numpy as np
 import networkx as nx
 from configparser import ConfigParser
 import signal
+from typing import List, Union
 
 from common_methods import (
+    Series,
+    load_run,
     read_csvs,
+    read_csvs_from_logstorage,
+    read_series_from_logstorage,
     write_metrics_to_file,
+    write_detection_to_file,
     create_metrics_for_node,
     create_metrics_for_run,
 )
 
+# seconds read before and after the detection time, enough samples for the interpolation
+WINDOW_MARGIN: float = 2
+
 
 def main():
-    detection_time = 20
+    detection_time = 20  # or a list of times, e.g. [10, 15, 20], detected in one pass
+    # host of the logstorage query api (e.g. "localhost" with kubectl port-forward),
+    # None reads the csv files in /evaluation/detect/
+    logstorage: str = None
 
     # create iterable with function args
     arguments = []
-    for csv in read_csvs():
-        arguments.append((csv, detection_time))
+    csvs = read_csvs() if logstorage is None else read_csvs_from_logstorage(logstorage)
+    for csv in csvs:
+        arguments.append((csv, detection_time, logstorage))
 
     if len(arguments) == 0:
         print(
@@ -47,13 +58,20 @@ def main():
             pool.terminate()
 
 
-def run_detection(csv: str, detection_time: float = 20) -> None:
+def run_detection(
+    csv: str,
+    detection_time: Union[float, List[float]] = 20,
+    logstorage: str = None,
+) -> None:
     """
     run_detection runs an community detection and analysis of a single run.
 
     Args:
         csv: the name of the csv of the run
-        detection_time: the time in seconds after the start at which values are compared
+        detection_time: the time in seconds after the start at which values are compared,
+            a list of times runs the detection for all of them in one pass
+        logstorage: host of the logstorage query api, if set only the samples around
+            detection_time are read from the logstorage instead of the csv
 
     Returns:
         None
@@ -63,6 +81,8 @@ def run_detection(csv: str, detection_time: float = 20) -> None:
     """
     start = time()  # for timing
 
+    detection_times = np.atleast_1d(np.asarray(detection_time, dtype=np.float64))
+
     cp = ConfigParser()
     config = csv[:-4]
 
@@ -83,24 +103,36 @@ def run_detection(csv: str, detection_time: float = 20) -> None:
     if synchro_type in ["mypotts", "clock"]:
         max_states: int = int(cp["0"]["max_states"])
 
-    # read and prepare dataframe
-    df = pd.read_csv(f"./detect/{csv}")
-    df = df.rename(index=lambda x: f"z{x}")
-    df = df[df.time <= max_time]
+    # read the samples of every node
+    if logstorage is None:
+        series = load_run(f"./detect/{csv}", max_time)
+    else:
+        series = read_series_from_logstorage(
+            config,
+            logstorage,
+            begin=detection_times.min() - WINDOW_MARGIN,
+            end=min(detection_times.max() + WINDOW_MARGIN, max_time),
+        )
 
     # community detection
-    detection, deviations = detect_communities(
+    detections, deviations = detect_communities_at_times(
         G=G,
-        df=df,
+        series=series,
         synchro_type=synchro_type,
-        detection_time=detection_time,
+        detection_times=detection_times,
         max_states=max_states,
     )
 
-    write_metrics_to_file(detection, f"{config}_nodes", overwrite=False)
+    for detection_time, detection in detections.items():
+        name = f"{config}_nodes"
+        if len(detections) > 1:
+            # the run stays second to last, majority_vote groups the runs by the name before it
+            cfg, _, run = config.rpartition("_")
+            name = f"{cfg}_at{detection_time:g}_{run}_nodes"
+        write_detection_to_file(detection, deviations, name, overwrite=False)
 
     # metrics
-    # metrics_nodes = create_metrics_for_node(G, detection)
+    # metrics_nodes = create_metrics_for_node(G, detection, deviations)
     # metrics = create_metrics_for_run(metrics_nodes, deviations)
 
     # write_metrics_to_file(metrics_nodes, f"{config}_nodes", overwrite=False)
@@ -111,7 +143,7 @@ def run_detection(csv: str, detection_time: float = 20) -> None:
 
 def detect_communities(
     G: nx.Graph,
-    df: pd.DataFrame,
+    series: Series,
     synchro_type: str,
     detection_time: float,
     max_states: int,
@@ -121,99 +153,129 @@ def detect_communities(
 
     Args:
         G: the graph of the network, used to get the neighbors of nodes
-        df: a dataframe containing a collumn time with time stamps and collumns for every node
+        series: times and values of the samples of every node, see common_methods.load_run()
         synchro_type: the used synchronization module, e.g. kuramoto, metropolis
         detection_time: the time after start of the synchronization at which values are compared
         max_states: not used if synchro_type is "kuramoto". gives the number of states
 
     Returns:
-        detection results: a dict containing the source nodes as keys and a nested dict as values.
+        detection results: a dict containing the source nodes as keys and a dict as values,
+            with the difference of the value of each neighbor, the smallest deviation at which it is "in".
             format of dection results:
             {
                 "1": {
-                    "deviation_1":{
-                        "in": ["2","3"],
-                        "out": ["4","5"]
-                    },
-                    "deviation_2":{
-                        "in": ["2","3","4"],
-                        "out": ["5"]
-                    },
+                    "2": 0.05,
+                    "3": 0.3,
                     ...
                 }
                 "2": {...}
             }
+            see common_methods.detection_at() for the in and out lists at a deviation
         deviations: list containing the used deviations
     """
+    detections, deviations = detect_communities_at_times(
+        G, series, synchro_type, [detection_time], max_states
+    )
+    return detections[float(detection_time)], deviations
 
-    interpolated: dict = {}
 
-    for node in G.nodes:  # interpolate
-        node: str = str(node)
+def detect_communities_at_times(
+    G: nx.Graph,
+    series: Series,
+    synchro_type: str,
+    detection_times: List[float],
+    max_states: int,
+) -> tuple[dict, list]:
+    """
+    detect_communities for several detection times in one pass
 
-        try:
-            d: dict = {"time": df["time"], node: df[node]}
-            df_node: pd.DataFrame = pd.DataFrame.from_dict(d)
-            df_node = df_node.dropna()
+    The values of all nodes at all times are looked up at once (see values_at),
+    the differences of all edges at all times are computed in one pass.
+
+    Returns:
+        detection time: detection results of that time, see detect_communities()
+        and the list of the used deviations
+    """
+    nodes = [str(node) for node in G.nodes]
+    missing = [node for node in nodes if len(series.get(node, ((), ()))[0]) == 0]
+    if missing:
+        print(f"nodes {missing} not found")
+        exit()
+
+    detection_times = np.asarray(detection_times, dtype=np.float64)
+    values = values_at(series, nodes, detection_times)
+
+    max_diff: float = 0
+    start: float = 0
+    step: float = 0
+    if synchro_type == "kuramoto":
+        max_diff = 2
+        start = 0.1
+        step = 0.1
+    elif synchro_type in ["mypotts", "metropolis", "clock"]:
+        max_diff = max_states // 2
+        start = max_diff * 0.05
+        step = max_diff * 0.05
+
+    deviations = [
+        float("%.2f" % deviation)  # remove floating point error
+        for deviation in np.arange(start, max_diff, step)
+    ]
+
+    # all edges in both directions, in the order of G.neighbors
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = [(s, str(t)) for s in nodes for t in G.neighbors(s)]
+    source = np.array([index[s] for s, _ in edges], dtype=np.int64)
+    target = np.array([index[t] for _, t in edges], dtype=np.int64)
+
+    diff = np.abs(values[target] - values[source])  # edge x time
+    diff = np.where(diff > max_diff, max_states - diff, diff)  # wrap around
+
+    # a neighbor is in at every deviation >= the difference
+    detections: dict = {}
+    for t, detection_time in enumerate(detection_times):
+        detection_results = {node: {} for node in nodes}
+        for (s, target_node), edge_diff in zip(edges, diff[:, t].tolist()):
+            detection_results[s][target_node] = edge_diff
+        detections[float(detection_time)] = detection_results
+
+    return detections, deviations
+
+
+def values_at(series: Series, nodes: List[str], times: np.ndarray) -> np.ndarray:
+    """
+    linear interpolation of the absolute values of the nodes at the times
 
-            vals = np.absolute(df_node[f"{node}"])
+    The samples of all nodes are put one after another, every node shifted into a time range of its own,
+    so one np.searchsorted finds the samples around all times for all nodes.
+    Times before the first or after the last sample of a node get the value of that sample.
 
-            interpolated[node] = InterpolatedUnivariateSpline(x=df_node["time"], y=vals)
-        except KeyError:
-            print(f"node {node} not found")
+    Returns:
+        one row per node, one collumn per time
+    """
+    counts = np.array([len(series[node][0]) for node in nodes], dtype=np.int64)
+    first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    last = first + counts - 1
 
-    detection_results = {}
-    deviations = []
-    # iterate over all nodes -> iterate over all neighbors
-    # -> compare if value difference is in deviation -> decide if in community
-    for source_node in G.nodes:
-        try:
-            source_node: str = str(source_node)
-            detection_results[source_node] = {}
-
-            t_source = interpolated[source_node](detection_time)
-
-            max_diff: float = 0
-            start: float = 0
-            step: float = 0
-            if synchro_type == "kuramoto":
-                max_diff = 2
-                start = 0.1
-                step = 0.1
-            elif synchro_type in ["mypotts", "metropolis", "clock"]:
-                max_diff = max_states // 2
-                start = max_diff * 0.05
-                step = max_diff * 0.05
-
-            deviations = []
-            for deviation in np.arange(start, max_diff, step):
-                deviation = float("%.2f" % deviation)  # remove floating point error
-                deviations.append(deviation)
-                detection_results[source_node][deviation] = {"in": [], "out": []}
-
-                for target_node in G.neighbors(source_node):
-                    target_node: str = str(target_node)
-
-                    t_target = interpolated[target_node](detection_time)
-
-                    diff = abs(t_target - t_source)
-
-                    if diff > max_diff:  # wrap around
-                        diff = max_states - diff
-
-                    if diff <= deviation:
-                        detection_results[source_node][deviation]["in"].append(
-                            target_node
-                        )
-                    else:
-                        detection_results[source_node][deviation]["out"].append(
-                            target_node
-                        )
-
-        except KeyError:
-            exit()
-
-    return detection_results, deviations
+    sample_times = np.concatenate([series[node][0] for node in nodes])
+    sample_values = np.absolute(np.concatenate([series[node][1] for node in nodes]))
+
+    low = min(sample_times.min(), times.min())
+    span = max(sample_times.max(), times.max()) - low + 1
+    shift = np.arange(len(nodes)) * span
+
+    keys = sample_times - low + np.repeat(shift, counts)
+    query = times[None, :] - low + shift[:, None]
+
+    right = np.searchsorted(keys, query)
+    right = np.clip(right, first[:, None], last[:, None])
+    left = np.clip(right - 1, first[:, None], last[:, None])
+
+    gap = keys[right] - keys[left]
+    weight = np.divide(query - keys[left], gap, out=np.zeros_like(query), where=gap > 0)
+    weight = np.clip(weight, 0, 1)
+
+    return sample_values[left] + weight * (sample_values[right] - sample_values[left])
 
 
 if __name__ == "__main__":
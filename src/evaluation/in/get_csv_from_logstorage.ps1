@@ -1,8 +1,12 @@
+# merge the stored segments of every run into one csv per run
+kubectl exec -it logstorage -- python storage.py export
+
 $kubectlls = kubectl exec -it logstorage -- ls
 
 foreach ($f in $kubectlls.split("")) {
     if($f -like "*.csv"){
         kubectl cp logstorage:$f $f
         kubectl exec -it logstorage -- rm $f
+        kubectl exec -it logstorage -- rm -r "runs/$($f.Substring(0, $f.Length - 4))"
     }
 }
@@ -1,11 +1,14 @@
 from configparser import ConfigParser
 import multiprocessing
 import os
-import json
+import re
 import signal
 import networkx as nx
+import numpy as np
 from common_methods import (
     read_csvs,
+    read_detection_edges,
+    edges_to_detection,
     write_metrics_to_file,
     create_metrics_for_node,
     create_metrics_for_run,
@@ -19,7 +22,7 @@ def main():
 
     files = [f for f in os.listdir("./gen/") if "nodes" in f]
 
-    configs = set(("_".join(f.split("_")[:-2]) for f in files))
+    configs = set(group(f) for f in files)
 
     args = []
     for cfg in configs:
@@ -38,9 +41,16 @@ def main():
             pool.terminate()
 
 
+def group(file: str) -> str:
+    """config of the runs a node file belongs to: the name without run and "_nodes",
+    e.g. cfg_3_nodes.json or cfg_at20_3_nodes.json of a detection at several times"""
+    return "_".join(file.split("_")[:-2])
+
+
 def majority_vote(cfg, _):
-    # read nodes of config
-    ini = [f for f in os.listdir("./detect/") if cfg in f and "ini" in f][0]
+    # read nodes of config, a group cfg_at<time> detected at several times uses the ini of cfg
+    config = re.sub(r"_at[-+.0-9e]+$", "", cfg)
+    ini = [f for f in os.listdir("./detect/") if config in f and "ini" in f][0]
 
     cp = ConfigParser()
     res = cp.read(f"./detect/{ini}")
@@ -49,60 +59,50 @@ def majority_vote(cfg, _):
     G: nx.Graph = nx.parse_graphml(graph)
     G: nx.Graph = nx.relabel_nodes(G, lambda n: n[1:] if "n" in n else n)
 
-    detections = [f for f in os.listdir("./gen/") if cfg in f]
-    runs = []
-    for d in detections:
-        with open(f"./gen/{d}") as f:
-            runs.append(json.load(f))
-
-    nr_of_runs = len(runs)
-
-    run1 = runs.pop(0)
-
-    result = {}
-    for node, dev_dict in run1.items():
-        node = str(node)
-        result[node] = {}
-        for dev, inout_dict in dev_dict.items():
-            dev = str(dev)
-            try:
-                result[node][dev] = {"in": [], "out": []}
-                for target in inout_dict["in"]:
-                    target = str(target)
-                    count_in = 0
-                    try:
-                        for run in runs:
-                            if target in run[node][dev]["in"]:
-                                count_in += 1
-                    except KeyError:
-                        pass
-
-                    if count_in > 0:
-                        result[node][dev]["in"].append(target)
-                    else:
-                        result[node][dev]["out"].append(target)
-            except TypeError:
-                pass
-
-            try:
-                for target in inout_dict["out"]:
-                    count_out = 0
-                    try:
-                        for run in runs:
-                            if target in run[node][dev]["out"]:
-                                count_out += 1
-                    except KeyError:
-                        pass
-
-                    if count_out > 0:
-                        result[node][dev]["out"].append(target)
-                    else:
-                        result[node][dev]["in"].append(target)
-            except TypeError:
-                pass
+    # a run converted from .json to .npz is read from the .npz only
+    detections = {}
+    for f in sorted(os.listdir("./gen/")):  # x.json before x.npz
+        if "_nodes" in f and group(f) == cfg:
+            detections[os.path.splitext(f)[0]] = f
+    detections = list(detections.values())
+
+    source, target, first_in, deviations = read_detection_edges(
+        f"./gen/{detections[0]}"
+    )
+    keys = edge_keys(source, target)
+
+    # first in deviations of the edges of run1 in the other runs, nan if missing in a run
+    others = np.full((len(detections) - 1, len(keys)), np.nan)
+    for row, d in enumerate(detections[1:]):
+        other_source, other_target, other_first_in, _ = read_detection_edges(
+            f"./gen/{d}"
+        )
+        if len(other_source) == 0:
+            continue
+
+        other_keys = edge_keys(other_source, other_target)
+        order = np.argsort(other_keys)
+        position = np.searchsorted(other_keys, keys, sorter=order)
+        position = order[np.minimum(position, len(order) - 1)]
+        found = other_keys[position] == keys
+        others[row, found] = other_first_in[position[found]]
+
+    # run1 decides if at least one other run agrees, otherwise the other runs decide:
+    # a neighbor in in run1 stays in if it is in in another run, one out in run1 stays out
+    # if it is out in another run. On the first in deviations that is run1 clipped to the
+    # range of the other runs.
+    known = ~np.isnan(others)
+    lowest = np.where(known, others, np.inf).min(axis=0, initial=np.inf)
+    highest = np.where(known, others, -np.inf).max(axis=0, initial=-np.inf)
+    voted = np.where(
+        known.any(axis=0), np.minimum(np.maximum(first_in, lowest), highest), first_in
+    )
+    result = edges_to_detection(source, target, voted)
+
     try:
-        deviations = list(result[list(result.keys())[0]].keys())
-        node_res = create_metrics_for_node(G=G, detection_results=result)
+        node_res = create_metrics_for_node(
+            G=G, detection_results=result, deviations=deviations
+        )
         run_res = create_metrics_for_run(node_res, deviations)
 
         write_metrics_to_file(run_res, f"{cfg}")
@@ -110,5 +110,10 @@ def majority_vote(cfg, _):
         pass
 
 
+def edge_keys(source: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """one string per edge to match the edges of different runs"""
+    return np.char.add(np.char.add(source.astype(str), "-"), target.astype(str))
+
+
 if __name__ == "__main__":
     main()
@@ -2,10 +2,11 @@ import os
 import networkx as nx
 import networkx.algorithms.community as nx_comm
 from scipy.interpolate import InterpolatedUnivariateSpline
-import pandas as pd
 from configparser import ConfigParser
 import matplotlib.pyplot as plt
 
+from common_methods import load_run
+
 cp = ConfigParser()
 csvs = [f for f in os.listdir("./in/") if ".csv" in f]
 
@@ -15,7 +16,6 @@ for csv in csvs:
     config = csv[:-4]
     print(config)
 
-    df = pd.read_csv(f"./in/{csv}")
     ini_file = f"{config}.ini"
     cp.read(f"./in/{ini_file}")
 
@@ -30,8 +30,7 @@ for csv in csvs:
         G, lambda n: n[1:] if "n" in n else n
     )  # i graph names nodes n0, n1 etc: remove leading n
 
-    df = df.rename(index=lambda x: f"z{x}")
-    df = df[df.time <= max_time]
+    series = load_run(f"./in/{csv}", max_time)
 
     interpolations: dict = {}
     for node in G.nodes:  # interpolieren
@@ -39,17 +38,15 @@ for csv in csvs:
         try:
             node: str = str(node)
 
-            d: dict = {"time": df["time"], node: df[node]}
-            df_node: pd.DataFrame = pd.DataFrame.from_dict(d)
-            df_node = df_node.dropna()
+            times, vals = series[node]
 
-            # pos = [abs(v) for v in df_node[f"{node}"]]
+            # pos = [abs(v) for v in vals]
 
             # interpolations[node] = InterpolatedUnivariateSpline(
-            #     x=df_node["time"], y=df_node[f"{node}"]
+            #     x=times, y=vals
             # )
 
-            plot = plt.plot(df_node["time"], df_node[f"{node}"])
+            plot = plt.plot(times, vals)
             plt.xlabel("time (s)")
             plt.ylabel("value")
 
@@ -1,14 +1,45 @@
-import pandas as pd
+import numpy as np
 import asyncio
 import json
+import re
+import socket
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from storage import SegmentStore
 
 # import time
 
+# frame header used by the nodes: payload length, correlation id, flags
+# has to match HEADER in node/connection.py
+HEADER = struct.Struct("!IIB")
+REQUEST: int = 1
+RESPONSE: int = 2
+
+# log batches start with the length of their json header, see node/logshipper.py
+BATCH_HEADER = struct.Struct("!H")
+
+# query results start with the length of their json header, see evaluation/common_methods.py
+QUERY_HEADER = struct.Struct("!I")
+
 
 background_tasks = set()
-file_lock = asyncio.Lock()
 
-big_d = pd.DataFrame()
+# one time and one value segment per node and run, merged into the run csv on export
+store = SegmentStore()
+
+# decoding and appending runs in worker processes, created in main()
+executor: ProcessPoolExecutor = None
+
+# most logs a shard stores with one manifest write
+MAX_GROUP: int = 1024
+
+# run_id: queue of the logs of the run that wait for ingestion
+# every run has its own worker, so logs of one run are appended one after another
+# while different runs are ingested in parallel
+shards: Dict[str, asyncio.Queue] = {}
 
 
 async def handle_con_task_wrapper(
@@ -22,64 +53,353 @@ async def handle_con_task_wrapper(
 
 
 async def handle_con(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    global big_d, file_lock
+    """Nodes keep their connection open and stream their logs in framed batches,
+    every batch is acknowledged after it is stored.
+    A connection starting with "{" carries a single plain json log.
+
+    Only the bytes are read here, decoding and storing happens in the shard of the run.
+    """
+    try:
+        first = await reader.readexactly(1)
+
+        if first == b"{":
+            data = first + await reader.read()
+            writer.close()
 
-    data = await reader.read()
-    message = data.decode()
+            future = enqueue(peek_log_run_id(data), decode_log, data)
+            await send_ack(None, None, 0, future)
+            return
 
-    writer.close()
-    await writer.wait_closed()
+        write_lck = asyncio.Lock()
+        while True:
+            header = first + await reader.readexactly(HEADER.size - len(first))
+            first = b""
+            length, cid, _ = HEADER.unpack(header)
+            data = await reader.readexactly(length)
 
+            try:
+                if data[:1] == b"{":
+                    future = enqueue(peek_log_run_id(data), decode_log, data)
+                else:
+                    future = enqueue(peek_batch_run_id(data), decode_batch, data)
+            except (ValueError, KeyError, TypeError, struct.error) as e:
+                # only this frame is malformed, the later batches of the connection are still read
+                future = asyncio.get_running_loop().create_future()
+                future.set_exception(e)
+
+            task = asyncio.create_task(send_ack(writer, write_lck, cid, future))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        writer.close()
+    except (ValueError, KeyError, struct.error) as e:
+        print(f"malformed log: {e}")
+        writer.close()
+
+
+async def send_ack(
+    writer: asyncio.StreamWriter,
+    write_lck: asyncio.Lock,
+    cid: int,
+    future: asyncio.Future,
+):
+    """Acknowledge a batch once it is stored.
+    Failed batches are answered with an error instead, so the node resends them without waiting for a timeout.
+    Plain json logs (writer None) get no acknowledgement."""
+    try:
+        run_id, node_id, seq, complete = await future
+        answer = {"ack": seq}
+    except (ValueError, KeyError, TypeError, OSError, struct.error, zlib.error) as e:
+        print(f"log not stored: {e!r}")
+        answer = {"error": repr(e)}
+    else:
+        if complete:
+            print(f"{run_id}: node {node_id} complete")
+
+    if writer is None:
+        return
+
+    answer = json.dumps(answer).encode()
     try:
-        msg_dict = json.loads(message)
+        async with write_lck:
+            writer.write(HEADER.pack(len(answer), cid, RESPONSE) + answer)
+            await writer.drain()
+    except ConnectionError:
+        pass
+
+
+def peek_batch_run_id(data: bytes) -> str:
+    """read the run id from the small uncompressed header of a batch"""
+    (header_length,) = BATCH_HEADER.unpack_from(data)
+    header = json.loads(data[BATCH_HEADER.size : BATCH_HEADER.size + header_length])
+    return header["run_id"]
 
-        new_df = await convert_dict_to_pd(msg_dict["data"])
 
-        new_df["time"] = new_df["time"].astype(float)
+def peek_log_run_id(data: bytes) -> str:
+    """find the run id of a plain json log without parsing the whole log"""
+    match = re.search(rb'"run_id": *"([^"]*)"', data)
+    if match is None:
+        raise KeyError("run_id")
+    return match.group(1).decode()
 
-        node_id = int(msg_dict["node"])
 
-        async with file_lock:
+def enqueue(run_id: str, decode: Callable, data: bytes) -> asyncio.Future:
+    """Put a log into the queue of its run, starting the worker of the run if needed
+
+    Returns:
+        future with the result of ingest_group() for the log
+    """
+    global shards, background_tasks
+
+    future = asyncio.get_running_loop().create_future()
+
+    try:
+        queue = shards[run_id]
+    except KeyError:
+        queue = asyncio.Queue()
+        shards[run_id] = queue
+
+        task = asyncio.create_task(shard_worker(run_id, queue))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    queue.put_nowait((decode, data, future))
+    return future
+
+
+async def shard_worker(run_id: str, queue: asyncio.Queue):
+    """Ingest the queued logs of one run in the process pool.
+
+    All logs that queued up while the previous group was stored are stored together as one group
+    (at most MAX_GROUP), with one manifest write and one fsync per segment for the whole group.
+    The worker ends when the queue is empty, the next log starts a new one."""
+    global shards, executor
+
+    loop = asyncio.get_running_loop()
+
+    while not queue.empty():
+        group = []
+        while not queue.empty() and len(group) < MAX_GROUP:
+            group.append(queue.get_nowait())
+
+        try:
+            results = await loop.run_in_executor(
+                executor, ingest_group, [(decode, data) for decode, data, _ in group]
+            )
+        except Exception as e:
+            results = [e] * len(group)
+
+        for (_, _, future), result in zip(group, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    del shards[run_id]
+
+
+def ingest_group(logs: List[Tuple[Callable, bytes]]) -> list:
+    """Decode logs of one run and append them to its segments. Runs in a worker process.
+
+    Batches that were already stored are ignored, so nodes can resend unacknowledged batches.
+    A malformed log only fails itself, not the rest of the group.
+
+    Returns:
+        for every log the exception that decoding it raised or
+        run id, node id, sequence number of the batch and if all batches of the node are stored
+    """
+    results = []
+    batches = []
+    for decode, data in logs:
+        try:
+            batches.append(decode(data))
+            results.append(None)
+        except (ValueError, KeyError, TypeError, struct.error, zlib.error) as e:
+            results.append(e)
+
+    if not batches:
+        return results
+
+    run_id = batches[0][0]
+    store.append_many(run_id, [batch[1:] for batch in batches])
+    complete = set(store.complete_nodes(run_id))
+
+    stored = iter(batches)
+    for i, result in enumerate(results):
+        if result is None:
+            _, node_id, seq, *_ = next(stored)
+            results[i] = (run_id, node_id, seq, node_id in complete)
+
+    return results
+
+
+def decode_batch(
+    data: bytes,
+) -> Tuple[str, int, int, np.ndarray, np.ndarray, bool, float]:
+    """Decode a batch of a node
+
+    Returns:
+        run id and node id, seq, times, values, last and resolution like SegmentStore.append_many() takes them
+    """
+    (header_length,) = BATCH_HEADER.unpack_from(data)
+    header = json.loads(data[BATCH_HEADER.size : BATCH_HEADER.size + header_length])
+
+    # raw little endian doubles: all times followed by all values
+    samples = np.frombuffer(
+        zlib.decompress(data[BATCH_HEADER.size + header_length :]), dtype="<f8"
+    )
+    times, values = np.split(samples, 2)
+
+    return (
+        header["run_id"],
+        int(header["node"]),
+        int(header["seq"]),
+        times,
+        values,
+        header["last"],
+        float(header["resolution"]),
+    )
+
+
+def decode_log(
+    data: bytes,
+) -> Tuple[str, int, int, np.ndarray, np.ndarray, bool, float]:
+    """decode a complete plain json log: {"run_id", "node", "data": {time: value}}, see decode_batch()"""
+    msg_dict = json.loads(data.decode())
+
+    times = np.array([float(t) for t in msg_dict["data"].keys()])
+    values = np.array([float(v) for v in msg_dict["data"].values()])
+
+    return msg_dict["run_id"], int(msg_dict["node"]), 0, times, values, True, 0.01
+
+
+async def handle_query_con(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answer framed json queries of the evaluation, see run_query() for the operations.
+    Queries of one connection are answered one after another."""
+    global executor
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            length, cid, _ = HEADER.unpack(await reader.readexactly(HEADER.size))
+            request = json.loads(await reader.readexactly(length))
 
             try:
-                old_df = pd.read_csv(f'{msg_dict["run_id"]}.csv')
-                old_df["time"] = old_df["time"].astype(float)
+                result = await loop.run_in_executor(executor, run_query, request)
+            except (ValueError, KeyError, TypeError, OSError) as e:
+                result = pack_query_result({"error": repr(e)})
+
+            writer.write(HEADER.pack(len(result), cid, RESPONSE) + result)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        writer.close()
+
+
+def run_query(request: dict) -> bytes:
+    """Answer a query. Runs in a worker process.
+
+    {"op": "runs"}: ids of all stored runs
+    {"op": "status", "run_id"}: "nodes" with logs in the run and the "complete" ones,
+        whose last batch and all batches before it are stored
+    {"op": "clear", "run_id"}: remove the stored logs of the run before it is run again,
+        otherwise the old batches count as complete and the new ones as duplicates
+    {"op": "query", "run_id", "nodes": [ids] or null for all, "begin": t or null, "end": t or null}:
+        the samples of the nodes in the time window, with the same alignment as the exported csv
+
+    Returns:
+        length of the json header, json header, raw little endian doubles:
+        times of the first node, values of the first node, times of the second node, ...
+        "nodes" and "counts" of the header give the node ids and the number of samples per node
+    """
+    if request["op"] == "runs":
+        return pack_query_result({"runs": store.runs()})
+
+    if request["op"] == "status":
+        run_id: str = request["run_id"]
+        return pack_query_result(
+            {
+                "run_id": run_id,
+                "nodes": store.nodes(run_id),
+                "complete": store.complete_nodes(run_id),
+            }
+        )
+
+    if request["op"] == "clear":
+        store.clear(request["run_id"])
+        return pack_query_result({"run_id": request["run_id"]})
 
-                df = pd.merge(new_df, old_df, on="time", how="outer")
-            except FileNotFoundError:
-                df = new_df
+    if request["op"] != "query":
+        raise ValueError(f"unknown op {request['op']}")
 
-            df.rename(columns={"values": str(node_id)}, inplace=True)
+    run_id: str = request["run_id"]
+    manifest = store.manifest(run_id)
 
-            df = df.sort_values("time", ascending=True)
-            df.to_csv(f'{msg_dict["run_id"]}.csv', index=False)
+    nodes = request.get("nodes")
+    if nodes is None:
+        nodes = sorted(int(n) for n in manifest["nodes"])
+    nodes = [int(n) for n in nodes if str(n) in manifest["nodes"]]
 
-            print(f"{msg_dict['run_id']}: {len(df.columns)-1}")
+    begin = request.get("begin")
+    end = request.get("end")
 
-    except json.JSONDecodeError:
-        print("not json")
-        print(message)
+    counts = []
+    columns = []
+    for node_id in nodes:
+        series = store.read_series(run_id, node_id, manifest)
+        series = series.loc[begin:end]  # index is sorted, None leaves the side open
 
+        counts.append(len(series))
+        columns.append(series.index.to_numpy(dtype="<f8").tobytes())
+        columns.append(series.to_numpy(dtype="<f8").tobytes())
 
-async def convert_dict_to_pd(msg_dict: dict):
-    w_added_labels = {"time": list(msg_dict.keys()), "values": list(msg_dict.values())}
-    return pd.DataFrame.from_dict(data=w_added_labels)
+    return pack_query_result(
+        {"run_id": run_id, "nodes": nodes, "counts": counts}, b"".join(columns)
+    )
 
 
-# async def get_node_column_labels(df: pd.DataFrame) -> list:
-#     col = list(df.columns)
-#     col.remove("time")
-#     return col
+def pack_query_result(header: dict, body: bytes = b"") -> bytes:
+    header = json.dumps(header).encode()
+    return QUERY_HEADER.pack(len(header)) + header + body
+
+
+def with_nodelay(handler: Callable) -> Callable:
+    """set TCP_NODELAY on every accepted connection, so acks and query results are sent right away"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        await handler(reader, writer)
+
+    return handle
 
 
 async def main():
-    server = await asyncio.start_server(handle_con_task_wrapper, "0.0.0.0", 50000)
+    global executor
+
+    executor = ProcessPoolExecutor()
+
+    # large backlog: all nodes of a run ship their logs at the same time
+    options = {"backlog": 1024, "reuse_address": True}
+    server = await asyncio.start_server(
+        with_nodelay(handle_con_task_wrapper), "0.0.0.0", 50000, **options
+    )
+    query_server = await asyncio.start_server(
+        with_nodelay(handle_query_con), "0.0.0.0", 50001, **options
+    )
 
     print("serving")
 
-    async with server:
-        await server.serve_forever()
+    async with server, query_server:
+        await asyncio.gather(server.serve_forever(), query_server.serve_forever())
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     asyncio.run(main())
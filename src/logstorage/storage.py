@@ -0,0 +1,228 @@
+import json
+import os
+import shutil
+import sys
+from typing import Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+# runs/<run_id>/manifest.json          nodes, stored batches and sample counts
+# runs/<run_id>/<node>.time.f64        append only little endian doubles
+# runs/<run_id>/<node>.value.f64
+ROOT = "runs"
+
+
+class SegmentStore:
+    """Append only columnar store: one time and one value segment per node and run.
+
+    Batches are appended to the segments of their node, the manifest records which batches
+    are stored and how many samples of a segment are valid.
+    A sample only counts once the manifest is written, partial writes of a crashed append
+    are cut off before the next append.
+    The wide per run table is built lazily when it is read or exported.
+
+    Manifests are read from disk on every access, so several processes can use the store
+    as long as only one of them appends to a run at a time.
+    """
+
+    def __init__(self, root: str = ROOT):
+        self.root = root
+
+    def run_dir(self, run_id: str) -> str:
+        return os.path.join(self.root, run_id)
+
+    def segment(self, run_id: str, node_id: int, column: str) -> str:
+        return os.path.join(self.run_dir(run_id), f"{node_id}.{column}.f64")
+
+    def manifest(self, run_id: str) -> dict:
+        try:
+            with open(os.path.join(self.run_dir(run_id), "manifest.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"run_id": run_id, "nodes": {}}
+
+    def write_manifest(self, run_id: str, manifest: dict, sync: bool = True) -> None:
+        path = os.path.join(self.run_dir(run_id), "manifest.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def clear(self, run_id: str) -> None:
+        """Remove all batches of the run, so a run with the same id is stored from the start"""
+        shutil.rmtree(self.run_dir(run_id), ignore_errors=True)
+
+    def runs(self) -> List[str]:
+        try:
+            return sorted(
+                r
+                for r in os.listdir(self.root)
+                if os.path.exists(os.path.join(self.root, r, "manifest.json"))
+            )
+        except FileNotFoundError:
+            return []
+
+    def append(
+        self,
+        run_id: str,
+        node_id: int,
+        seq: int,
+        times: np.ndarray,
+        values: np.ndarray,
+        last: bool = False,
+        resolution: float = 0.01,
+    ) -> bool:
+        """Append a batch of samples of a node.
+
+        Returns:
+            False if the batch was already stored, True otherwise
+        """
+        return self.append_many(
+            run_id, [(node_id, seq, times, values, last, resolution)]
+        )[0]
+
+    def append_many(
+        self,
+        run_id: str,
+        batches: Iterable[Tuple[int, int, np.ndarray, np.ndarray, bool, float]],
+        sync: bool = True,
+    ) -> List[bool]:
+        """Append several batches of a run with one manifest write.
+
+        Every segment is fsynced once and the manifest is written once at the end,
+        so appending many batches costs one manifest write instead of one per batch.
+        The batches only count once the manifest is written, like with append().
+
+        Args:
+            batches: node id, seq, times, values, last and resolution of every batch
+            sync: fsync the segments and the manifest, so the batches survive a crash of the machine
+
+        Returns:
+            for every batch False if it was already stored, True otherwise
+        """
+        manifest = self.manifest(run_id)
+        os.makedirs(self.run_dir(run_id), exist_ok=True)
+
+        stored = []
+        touched = set()  # segments written by this call
+        for node_id, seq, times, values, last, resolution in batches:
+            entry = manifest["nodes"].setdefault(
+                str(node_id),
+                {"samples": 0, "batches": [], "last": None, "resolution": resolution},
+            )
+
+            if seq in entry["batches"]:
+                stored.append(False)
+                continue
+
+            for column, data in (("time", times), ("value", values)):
+                path = self.segment(run_id, node_id, column)
+                with open(path, "ab") as f:
+                    if path not in touched:
+                        # drop leftovers of a crashed append
+                        f.truncate(8 * entry["samples"])
+                        touched.add(path)
+                    f.write(np.asarray(data, dtype="<f8").tobytes())
+
+            entry["samples"] += len(times)
+            entry["batches"].append(seq)
+            entry["resolution"] = resolution
+            if last:
+                entry["last"] = seq
+            stored.append(True)
+
+        # segments are closed right after writing, a run can have more nodes than open files are allowed
+        if sync:
+            for path in touched:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+        if any(stored):
+            self.write_manifest(run_id, manifest, sync)
+        return stored
+
+    def is_complete(self, run_id: str, node_id: int) -> bool:
+        """True if the last batch of the node and all batches before it are stored"""
+        try:
+            entry = self.manifest(run_id)["nodes"][str(node_id)]
+        except KeyError:
+            return False
+        return entry["last"] is not None and len(entry["batches"]) == entry["last"] + 1
+
+    def complete_nodes(self, run_id: str) -> List[int]:
+        """ids of the nodes whose last batch and all batches before it are stored"""
+        return sorted(
+            int(n)
+            for n, entry in self.manifest(run_id)["nodes"].items()
+            if entry["last"] is not None and len(entry["batches"]) == entry["last"] + 1
+        )
+
+    def nodes(self, run_id: str) -> List[int]:
+        return sorted(int(n) for n in self.manifest(run_id)["nodes"])
+
+    def read_node(self, run_id: str, node_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return times and values of a node in the order they were stored"""
+        entry = self.manifest(run_id)["nodes"][str(node_id)]
+        return self.read_segments(run_id, node_id, entry["samples"])
+
+    def read_segments(
+        self, run_id: str, node_id: int, count: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        times = np.fromfile(self.segment(run_id, node_id, "time"), "<f8", count)
+        values = np.fromfile(self.segment(run_id, node_id, "value"), "<f8", count)
+        return times, values
+
+    def read_series(
+        self, run_id: str, node_id: int, manifest: dict = None
+    ) -> pd.Series:
+        """Samples of a node indexed by time aligned to the resolution of the node.
+
+        Like the old string keyed history the last sample of a time slot wins.
+        """
+        if manifest is None:
+            manifest = self.manifest(run_id)
+        entry = manifest["nodes"][str(node_id)]
+
+        times, values = self.read_segments(run_id, node_id, entry["samples"])
+        resolution = entry["resolution"]
+        times = (np.round(times / resolution) * resolution).round(6)
+
+        series = pd.Series(values, index=times, name=str(node_id))
+        series = series[~series.index.duplicated(keep="last")]
+        return series.sort_index()
+
+    def to_wide(self, run_id: str, nodes: List[int] = None) -> pd.DataFrame:
+        """Merge the segments into the wide table: a time column and one column per node"""
+        manifest = self.manifest(run_id)
+        if nodes is None:
+            nodes = sorted(int(n) for n in manifest["nodes"])
+
+        df = pd.concat([self.read_series(run_id, n, manifest) for n in nodes], axis=1)
+        df = df.sort_index()
+        df.index.name = "time"
+        return df.reset_index()
+
+    def export_csv(self, run_id: str, path: str = None) -> str:
+        """Write the wide table of the run as csv in the format the evaluation scripts read"""
+        if path is None:
+            path = f"{run_id}.csv"
+
+        self.to_wide(run_id).to_csv(path, index=False)
+        return path
+
+
+if __name__ == "__main__":
+    # python storage.py export [run_id ...]: write the csv of the given (or all) runs
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        print("usage: python storage.py export [run_id ...]")
+        sys.exit(1)
+
+    store = SegmentStore()
+    for run_id in sys.argv[2:] or store.runs():
+        print(f"exported {store.export_csv(run_id)}")
@@ -0,0 +1,305 @@
+import asyncio
+import os
+import struct
+from typing import Dict, Tuple
+
+from resolver import Resolver
+from runtime import set_nodelay, socket_path
+from synchronisation.codec import JSON, encode
+from synchronisation.interface import Reply, SendingMessageError
+
+# every frame starts with: payload length, correlation id, flags
+# flags: frame kind in the low 4 bits, codec of the payload in the high 4 bits
+# the logstorage server uses the same layout (see logstorage/server.py)
+HEADER = struct.Struct("!IIB")
+
+ONEWAY: int = 0
+REQUEST: int = 1
+RESPONSE: int = 2
+
+# payloads of frames between nodes start with the id of the destination node,
+# one process can host several nodes (see NodeHost in node.py)
+DESTINATION = struct.Struct("!I")
+
+
+async def read_frame(
+    reader: asyncio.StreamReader, prefix: bytes = b""
+) -> Tuple[int, int, int, bytes]:
+    """Read one frame from the stream.
+
+    Args:
+        reader: the stream to read from
+        prefix: bytes of the header that were already read by the caller
+
+    Returns:
+        kind, codec, correlation id and payload of the frame
+
+    Raises:
+        asyncio.IncompleteReadError: if the stream ends within a frame
+    """
+    header = prefix + await reader.readexactly(HEADER.size - len(prefix))
+    length, cid, flags = HEADER.unpack(header)
+    payload = await reader.readexactly(length)
+    return flags & 0x0F, flags >> 4, cid, payload
+
+
+class FrameWriter:
+    """Writes frames to a stream, one frame at a time.
+
+    Several tasks share one connection, so writing and draining is serialised by a lock.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.write_lck = asyncio.Lock()
+
+    async def write(
+        self, payload: bytes, cid: int = 0, kind: int = ONEWAY, codec: int = JSON
+    ) -> None:
+        async with self.write_lck:
+            header = HEADER.pack(len(payload), cid, kind | codec << 4)
+            self.writer.write(header + payload)
+            await self.writer.drain()
+
+    def is_closing(self) -> bool:
+        return self.writer.is_closing()
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class StreamReply(Reply):
+    """Handle to answer a received message, passed to the synchronisation modules.
+
+    Framed connections answer with a response frame carrying the correlation id of the request,
+    encoded with the codec of the request.
+    Plain connections (e.g. from the controller) get plain json.
+    """
+
+    def __init__(
+        self,
+        frames: FrameWriter = None,
+        cid: int = 0,
+        codec: int = JSON,
+        writer: asyncio.StreamWriter = None,
+    ):
+        self.frames = frames
+        self.cid = cid
+        self.codec = codec
+        self.writer = writer
+
+    async def send(self, msg: dict) -> None:
+        try:
+            if self.frames is not None:
+                codec, payload = encode(msg, self.codec)
+                await self.frames.write(payload, self.cid, RESPONSE, codec)
+            else:
+                _, payload = encode(msg, JSON)
+                self.writer.write(payload)
+                await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            print(f"{e}: failed sending reply")
+
+
+class LocalReply(Reply):
+    """Answers a request between two nodes of the same process by resolving the future of the requester"""
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+
+    async def send(self, msg: dict) -> None:
+        if not self.future.done():
+            self.future.set_result(dict(msg))
+
+
+class PeerConnection:
+    """A long lived connection to another node or the logstorage.
+
+    Requests and responses are multiplexed over one stream: every request gets a correlation id
+    and the read loop hands the matching response to the waiting caller.
+    The connection is opened lazily and reopened once if it turns out to be stale.
+    A host running on the same machine is reached over its unix socket (see runtime.socket_path),
+    otherwise over TCP.
+    The host is resolved through the shared resolver cache, a failed connection drops its entry.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 50000,
+        timeout: float = 5,
+        resolver: Resolver = None,
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.resolver = resolver if resolver is not None else Resolver()
+
+        self.frames: FrameWriter = None
+        # correlation id: future of (codec, payload) of the response
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.next_cid: int = 1
+
+        self.connect_lck = asyncio.Lock()
+        self.read_task: asyncio.Task = None
+
+    def is_connected(self) -> bool:
+        return self.frames is not None and not self.frames.is_closing()
+
+    async def connect(self) -> None:
+        async with self.connect_lck:
+            if self.is_connected():
+                return
+
+            reader, writer = await self.open_unix_connection()
+            if writer is None:
+                ip = await asyncio.wait_for(
+                    self.resolver.resolve(self.host), self.timeout
+                )
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(ip, self.port), self.timeout
+                )
+                set_nodelay(writer)
+
+            # each connection gets its own pending dict, so a dying connection
+            # only fails the requests that were sent over it
+            self.frames = FrameWriter(writer)
+            self.pending = {}
+            self.read_task = asyncio.create_task(
+                self.read_loop(reader, self.frames, self.pending)
+            )
+
+    async def open_unix_connection(
+        self,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Connect over the unix socket of the host if it runs on this machine, (None, None) otherwise"""
+        path = socket_path(self.host)
+        if path is None or not os.path.exists(path):
+            return None, None
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_unix_connection(path), self.timeout
+            )
+        except (asyncio.TimeoutError, OSError):
+            return None, None  # socket file of a stopped process
+
+    async def read_loop(
+        self,
+        reader: asyncio.StreamReader,
+        frames: FrameWriter,
+        pending: Dict[int, asyncio.Future],
+    ) -> None:
+        try:
+            while True:
+                kind, codec, cid, payload = await read_frame(reader)
+                if kind != RESPONSE:
+                    continue
+
+                future = pending.pop(cid, None)
+                if future is not None and not future.done():
+                    future.set_result((codec, payload))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError())
+            pending.clear()
+            self.drop(frames)
+
+    def drop(self, frames: FrameWriter) -> None:
+        frames.close()
+        if self.frames is frames:
+            self.frames = None
+
+    async def transmit(
+        self,
+        payload: bytes,
+        kind: int = ONEWAY,
+        codec: int = JSON,
+        future: asyncio.Future = None,
+    ) -> Tuple[Dict[int, asyncio.Future], int]:
+        """Write a frame, reconnecting once if the connection went stale.
+
+        Returns:
+            the pending dict of the used connection and the correlation id of the frame
+
+        Raises:
+            SendingMessageError
+        """
+        for _ in range(2):
+            cid = 0
+            pending = {}
+            frames = None
+            try:
+                await self.connect()
+                frames = self.frames
+                pending = self.pending
+
+                if future is not None:
+                    cid = self.next_cid
+                    self.next_cid = self.next_cid % 0xFFFFFFFF + 1
+                    pending[cid] = future
+
+                await frames.write(payload, cid=cid, kind=kind, codec=codec)
+                return pending, cid
+            except (asyncio.TimeoutError, ConnectionError, OSError):
+                pending.pop(cid, None)
+                self.resolver.invalidate(self.host)
+                if frames is not None:
+                    self.drop(frames)
+
+        raise SendingMessageError
+
+    async def send(self, payload: bytes, codec: int = JSON) -> None:
+        await self.transmit(payload, codec=codec)
+
+    async def request(self, payload: bytes, codec: int = JSON) -> Tuple[int, bytes]:
+        """Send a request and wait for the response with the same correlation id.
+
+        Returns:
+            codec and payload of the response
+
+        Raises:
+            SendingMessageError
+        """
+        future = asyncio.get_running_loop().create_future()
+        pending, cid = await self.transmit(
+            payload, kind=REQUEST, codec=codec, future=future
+        )
+
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            raise SendingMessageError
+        finally:
+            pending.pop(cid, None)
+
+    def close(self) -> None:
+        if self.frames is not None:
+            self.drop(self.frames)
+
+
+class ConnectionPool:
+    """Keeps one PeerConnection per host and port"""
+
+    def __init__(self, timeout: float = 5, resolver: Resolver = None):
+        self.timeout = timeout
+        self.resolver = resolver if resolver is not None else Resolver()
+        self.connections: Dict[Tuple[str, int], PeerConnection] = {}
+
+    def get(self, host: str, port: int = 50000) -> PeerConnection:
+        try:
+            return self.connections[(host, port)]
+        except KeyError:
+            connection = PeerConnection(
+                host, port, timeout=self.timeout, resolver=self.resolver
+            )
+            self.connections[(host, port)] = connection
+            return connection
+
+    def close(self) -> None:
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
@@ -0,0 +1,85 @@
+from array import array
+from typing import Tuple
+
+
+class History:
+    """Samples (time since start, state/signal) of one run in two preallocated double arrays.
+
+    The buffers double their size when they are full.
+    With a capacity the history is a ring buffer that keeps only the newest "capacity" samples.
+    Samples are stored with their exact time, "resolution" is the time resolution
+    the logstorage uses to align the samples of different nodes.
+    """
+
+    def __init__(
+        self, initial_size: int = 1024, capacity: int = None, resolution: float = 0.01
+    ):
+        if capacity is not None and capacity <= 0:
+            raise ValueError(f"capacity must be positive, got {capacity}")
+        if initial_size <= 0:
+            raise ValueError(f"initial_size must be positive, got {initial_size}")
+        if resolution <= 0:
+            raise ValueError(f"resolution must be positive, got {resolution}")
+
+        size = capacity if capacity is not None else initial_size
+
+        self.times = array("d", bytes(8 * size))
+        self.values = array("d", bytes(8 * size))
+        self.capacity: int = capacity
+        self.resolution: float = resolution
+
+        self.total: int = 0  # number of samples ever appended
+
+    def __len__(self) -> int:
+        if self.capacity is None:
+            return self.total
+        return min(self.total, self.capacity)
+
+    def append(self, t: float, value: float) -> None:
+        if self.capacity is None:
+            if self.total == len(self.times):
+                self.grow()
+            index = self.total
+        else:
+            index = self.total % self.capacity
+
+        self.times[index] = t
+        self.values[index] = value
+        self.total += 1
+
+    def grow(self) -> None:
+        zeros = bytes(8 * len(self.times))
+        self.times.frombytes(zeros)
+        self.values.frombytes(zeros)
+
+    def since(self, cursor: int) -> Tuple[array, array, int]:
+        """Return the samples appended after the first "cursor" samples.
+
+        In ring mode samples that were already overwritten are skipped.
+
+        Returns:
+            times, values and the cursor to pass next time
+        """
+        if self.capacity is None:
+            return (
+                self.times[cursor : self.total],
+                self.values[cursor : self.total],
+                self.total,
+            )
+
+        start = max(cursor, self.total - self.capacity)
+        times = array("d")
+        values = array("d")
+        for first, last in self.ranges(start, self.total):
+            times.extend(self.times[first:last])
+            values.extend(self.values[first:last])
+
+        return times, values, self.total
+
+    def ranges(self, start: int, end: int) -> list:
+        """buffer index ranges of the samples start to end in ring mode"""
+        first = start % self.capacity
+        count = end - start
+        if first + count <= self.capacity:
+            return [(first, first + count)]
+        return [(first, self.capacity), (0, first + count - self.capacity)]
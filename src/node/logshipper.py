@@ -0,0 +1,108 @@
+import asyncio
+import json
+import struct
+import sys
+import zlib
+from typing import Dict
+
+from connection import PeerConnection
+from history import History
+from synchronisation.interface import SendingMessageError
+
+# a batch is: length of the json header, json header,
+# zlib compressed raw little endian doubles: all new times followed by all new values
+# has to match the parsing in logstorage/server.py
+BATCH_HEADER = struct.Struct("!H")
+
+
+class LogShipper:
+    """Streams the history of one run to the logstorage in compressed batches while the run is going on.
+
+    Every batch gets a sequence number and stays buffered until the logstorage acknowledges it,
+    batches without acknowledgement are sent again with the next flush.
+    The logstorage ignores batches it already stored, so resending is safe.
+    """
+
+    def __init__(
+        self,
+        connection: PeerConnection,
+        run_id: str,
+        node_id: int,
+        history: History,
+        interval: float = 2,
+    ):
+        self.connection = connection
+        self.run_id = run_id
+        self.node_id = node_id
+        self.history = history
+        self.interval = interval
+
+        self.seq: int = 0  # sequence number of the next batch
+        self.cursor: int = 0  # number of samples already put into a batch
+        self.unacked: Dict[int, bytes] = {}  # seq: batch
+
+        self.task: asyncio.Task = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.ship_loop())
+
+    def stop(self) -> None:
+        """Stop the periodic shipping without sending the rest, e.g. if the node gets the config of a new run"""
+        if self.task is not None:
+            self.task.cancel()
+
+    async def ship_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.cut_batch()
+            await self.flush()
+
+    def cut_batch(self, last: bool = False) -> None:
+        """Put all samples since the last batch into a new batch"""
+        times, values, self.cursor = self.history.since(self.cursor)
+        if not times and not last:
+            return
+
+        if sys.byteorder == "big":
+            times.byteswap()
+            values.byteswap()
+
+        header = json.dumps(
+            {
+                "run_id": self.run_id,
+                "node": self.node_id,
+                "seq": self.seq,
+                "last": last,
+                "resolution": self.history.resolution,
+            }
+        ).encode()
+
+        body = zlib.compress(times.tobytes() + values.tobytes())
+        self.unacked[self.seq] = BATCH_HEADER.pack(len(header)) + header + body
+        self.seq += 1
+
+    async def flush(self) -> bool:
+        """Send all unacknowledged batches in order.
+
+        Returns:
+            True if every batch is acknowledged
+        """
+        for seq in sorted(self.unacked):
+            try:
+                _, response = await self.connection.request(self.unacked[seq])
+                if json.loads(response)["ack"] == seq:
+                    del self.unacked[seq]
+            except (SendingMessageError, ValueError, KeyError):
+                return False
+
+        return not self.unacked
+
+    async def finish(self) -> None:
+        """Stop the periodic shipping, send the remaining entries and wait until everything is acknowledged"""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+        self.cut_batch(last=True)
+        while not await self.flush():
+            await asyncio.sleep(0.5)
@@ -1,6 +1,7 @@
 import sys
-from typing import Tuple, Dict
-
+import os
+import socket
+from typing import Dict, Tuple
 
 sys.path.append("..")
 
@@ -8,30 +9,67 @@ from synchronisation.kuramoto import KuramotoModell
 from synchronisation.clock import Clock
 from synchronisation.metrohasting import MetroHasting
 from synchronisation.bsrg import BSRG
-from synchronisation.interface import SendingMessageError, Synchronisation_Interface
+from synchronisation.interface import (
+    BroadcastError,
+    Reply,
+    SendingMessageError,
+    Synchronisation_Interface,
+)
+from synchronisation import codec
+from connection import (
+    DESTINATION,
+    ConnectionPool,
+    FrameWriter,
+    LocalReply,
+    StreamReply,
+    read_frame,
+)
+from history import History
+from logshipper import LogShipper
+from resolver import Resolver
+from runtime import LoopLagMonitor
+import runtime
 import asyncio
 from random import choice
-import json
-from socket import gaierror, gethostbyname
+import re
+import struct
+import time
+
+# answer to the config and start messages of the controller
+ACK: dict = {"type": "node", "operation": "ack"}
+# answers to a start time that already passed and to the cancellation of a start that already happened
+LATE: dict = {"type": "node", "operation": "late"}
+STARTED: dict = {"type": "node", "operation": "started"}
+
+# number of nodes hosted by one process (pod), has to be the same for all nodes and the controller
+NODES_PER_PROCESS: int = int(os.environ.get("NODES_PER_PROCESS", 1))
+
+# TCP port of this process, several processes on one machine need one each (see start.sh)
+NODE_PORT: int = int(os.environ.get("NODE_PORT", 50000))
 
 
 class Node:
-    def __init__(self):
-        self.id: int = None
+    """One node of the graph: its neighbors, synchronisation module and history.
+
+    The server, the connections and the event loop belong to the NodeHost,
+    which can host several nodes in one process.
+    Ids are the node ids of the run, the node with id n of the run lives in the slot n + offset
+    of the node pool (the controller runs several runs on disjoint slots, see control.py).
+    """
+
+    def __init__(self, host: "NodeHost", id: int):
+        self.host = host
+        self.id: int = id
+        self.offset: int = 0
         self.neighbors: list[int] = None
         self.synchronization_module: Synchronisation_Interface = None
         self.degree: int = None
+        self.codec: int = codec.JSON  # codec for synchronisation messages
 
-        # Dict: timestamp since start  - state/signal
-        self.history: Dict[float, float] = {}
-
-        self.background_tasks = (
-            set()
-        )  # to keep a reference to background tasks, so they do not get garbage collected
-
-        # to store ip locally so no dns call is needed
-        # currently not used
-        self.local_ip_cache = {}
+        # samples: time since start - state/signal
+        self.history: History = History()
+        self.log_shipper: LogShipper = None
+        self.start_task: asyncio.Task = None  # waits for the start time of the run
 
     def register_synchronisation_modell(self, msg: dict) -> None:
         if msg["synchronization_model"] == "kuramoto":
@@ -46,13 +84,40 @@ class Node:
         self.synchronization_module.register_new_config(msg=msg)
 
     def register_new_node_config(self, msg: dict) -> None:
-        self.id = msg["node_id"]
+        self.id = int(msg["node_id"])
+        self.offset = int(msg.get("node_offset", 0))
         self.neighbors = [int(id) for id in msg["neighbors"].split("-")]
         self.degree = len(self.neighbors)
-        self.history = {}
-        self.background_tasks = set()
-        self.local_ip_cache = {}
-        # self.setup_local_ip_cache()
+        try:
+            self.codec = codec.CODECS[msg["codec"]]
+        except KeyError:
+            self.codec = codec.JSON
+        try:
+            self.history = History(capacity=int(msg["history_capacity"]))
+        except KeyError:
+            self.history = History()
+
+        # the history is streamed to the logstorage while the run is going on,
+        # the shipper of the previous run must not keep flushing its batches
+        if self.log_shipper is not None:
+            self.log_shipper.stop()
+        self.log_shipper = LogShipper(
+            connection=self.host.connections.get("logstorage", 50000),
+            run_id=msg["run"],
+            node_id=self.id,
+            history=self.history,
+        )
+        self.log_shipper.start()
+
+        # the start task belongs to the previous run: a pending start must not start this run
+        # and a finished one must not answer the cancel_start of this run with STARTED
+        if self.start_task is not None:
+            self.start_task.cancel()
+        self.start_task = None
+
+        # resolve all neighbors at once instead of one dns call per first message
+        hosts = {self.host.get_node_address(id + self.offset) for id in self.neighbors}
+        self.host.spawn(self.host.resolver.prefetch(list(hosts) + ["logstorage"]))
 
     def get_neighbors(self) -> list[int]:
         return self.neighbors
@@ -61,124 +126,234 @@ class Node:
         return choice(self.neighbors)
 
     async def send_logs(self) -> None:
-        msg = json.dumps(
-            {
-                "run_id": self.synchronization_module.run,
-                "node": int(self.id),
-                "data": self.history,
-            }
-        )
-
-        while True:
-            try:
-                writer, _ = await self.send_message_to(
-                    msg=msg, to="logstorage", port=50000
-                )
+        """Send the rest of the history and wait until the logstorage stored all of it"""
+        await self.log_shipper.finish()
 
-                writer.write_eof()
-                writer.close()
-                await writer.wait_closed()
-
-                print(f"SEND LOGS: {sys.getsizeof(msg)}")
-                return
-            except SendingMessageError:
-                await asyncio.sleep(0.5)
+        print(f"SEND LOGS: {self.log_shipper.seq} batches")
 
-    async def start_server(self):
-        server = await asyncio.start_server(self.handle_connection, "0.0.0.0", 50000)
+    async def request_random_neighbor(self, msg: dict) -> Tuple[int, dict]:
+        neighborid: int = self.get_random_neighbor()
 
-        async with server:
-            await server.serve_forever()
+        response = await self.host.request(neighborid + self.offset, msg, self.codec)
+        return neighborid, response
 
-    async def send_message_to_local_cache(
-        self, msg: str, to_node_id: str = None, port: int = 50000, direct: str = None
-    ) -> Tuple[asyncio.StreamWriter, asyncio.StreamReader]:
-        """Method to send a message using the local cache
+    async def send_message_to_all_neighbors(
+        self, msg: dict, neighbors: list[int] = None
+    ) -> None:
+        """Send a message to all neighbors concurrently.
 
-        Use either to_node_id or direct.
-        Use direct to provide an ip to send to or to_node_id to use the local cache/DNS to send to node with the given id
+        A failing neighbor does not stop the others, so callers can retry only the failed ones
+        by passing them as "neighbors".
 
         Args:
             msg: the message
-            to_node_id: the id of the node one wants to send the message.
-            direct: ip of the receipient
-            port: port to send to
+            neighbors: send only to these neighbors instead of all
 
-        Returns:
-            asyncio Streamwriter: to write to the TCP connection
-            asyncio Streamwreader: to read from the TCP connection
+        Raises:
+            BroadcastError: containing the ids of the neighbors that did not get the message
+        """
+        if neighbors is None:
+            neighbors = self.neighbors
 
+        async def send(id: int) -> None:
+            async with self.host.broadcast_semaphore:
+                await self.host.send(id + self.offset, msg, self.codec)
 
-        Raises:
-            SendingMessageError
+        results = await asyncio.gather(
+            *(send(id) for id in neighbors), return_exceptions=True
+        )
+
+        failed = []
+        for id, result in zip(neighbors, results):
+            if isinstance(result, SendingMessageError):
+                failed.append(id)
+            elif isinstance(result, BaseException):
+                raise result
+
+        if failed:
+            raise BroadcastError(failed)
 
+    async def handle_message(self, msg_dict: dict, reply: Reply) -> None:
+        """Call the corresponding functions for a decoded message.
+
+        if "type" is "node" the message is meant to be handled by the node
+        if "type" is "synchronization" the messaged is passed to the "handle" function of the set synchronization module
+
+        Config messages, share_state messages and start messages with a "start_at" time are acknowledged,
+        so the controller knows that every node is ready before the run starts.
+        share_state is acknowledged before the state is broadcast, as the broadcast retries until all neighbors got it.
+        A start time that already passed is answered with LATE, and a start can be cancelled until it happened,
+        afterwards start and cancel_start of the run are answered with STARTED.
         """
+        if msg_dict["type"] == "node":
+            if msg_dict["operation"] == "config":
+                self.register_new_node_config(msg_dict)
+                self.register_synchronisation_modell(msg_dict)
+                await reply.send(ACK)
+        elif (
+            msg_dict["type"] == "synchronization"
+            and self.synchronization_module is not None
+        ):
+            if msg_dict["operation"] == "start" and "start_at" in msg_dict:
+                start_at = float(msg_dict.pop("start_at"))
+                if self.started():
+                    await reply.send(STARTED)
+                    return
+                if time.time() >= start_at:
+                    await reply.send(LATE)
+                    return
+                # a retried start replaces the pending one, whose cancel_start may have been lost
+                if self.start_task is not None:
+                    self.start_task.cancel()
+                self.start_task = self.host.spawn(self.start_at(start_at, msg_dict))
+                await reply.send(ACK)
+                return
+            if msg_dict["operation"] == "cancel_start":
+                if self.started():
+                    await reply.send(STARTED)
+                    return
+                if self.start_task is not None:
+                    self.start_task.cancel()
+                await reply.send(ACK)
+                return
+            if msg_dict["operation"] == "share_state":
+                self.host.spawn(
+                    self.synchronization_module.handle(msg=msg_dict, reply=Reply())
+                )
+                await reply.send(ACK)
+                return
 
-        while True:
             try:
-                if direct:
-                    reader, writer = await asyncio.open_connection(direct, port)
-                else:
-                    try:
-                        ip = self.local_ip_cache[to_node_id]
-                    except KeyError:
-                        pass
-                    reader, writer = await asyncio.open_connection(ip, port)
-
-                writer.write(msg.encode())
-                await writer.drain()
-                return writer, reader
-
-            except (TimeoutError, ConnectionResetError, gaierror, OSError) as e:
-                # this happens a lot in big networks so we give it an extra option
-                if direct == "logstorage":
-                    continue
-
-                print(f"{e}: failed sending msg to id: {to_node_id} \n{msg}")
-                if e == TimeoutError:
-                    self.check_local_ip_cache_entry(to_node_id)
-                else:
-                    raise SendingMessageError
-
-    async def send_message_to(
-        self, msg: str, to: str = None, port: int = 50000
-    ) -> Tuple[asyncio.StreamWriter, asyncio.StreamReader]:
+                await self.synchronization_module.handle(msg=msg_dict, reply=reply)
+            except AttributeError:
+                print("No synchronization module with handle function!")
+
+    def started(self) -> bool:
+        """True if the start of the current run already happened"""
+        return (
+            self.start_task is not None
+            and self.start_task.done()
+            and not self.start_task.cancelled()
+        )
 
-        try:
-            reader, writer = await asyncio.open_connection(to, port)
+    async def start_at(self, start_at: float, msg: dict) -> None:
+        """Pass the start message to the synchronisation module at the wall clock time start_at,
+        so all nodes of a run start at the same time"""
+        await asyncio.sleep(max(0, start_at - time.time()))
+        await self.synchronization_module.handle(msg=msg, reply=Reply())
 
-            writer.write(msg.encode())
-            await writer.drain()
-            return writer, reader
 
-        except (TimeoutError, ConnectionResetError, gaierror, OSError):
-            raise SendingMessageError
+class NodeHost:
+    """Runs the nodes of one process with one server, one connection pool and one event loop.
 
-    async def send_message_to_random_neighbor(
-        self, msg: str
-    ) -> Tuple[int, asyncio.StreamWriter, asyncio.StreamReader]:
-        neighborid: int = self.get_random_neighbor()
+    The slots of the node pool are split into blocks of "per_process": slot s is hosted by the process
+    s // per_process, which is reachable as node-{s // per_process} (the pod of the StatefulSet).
+    Messages between nodes of the same process are handed over in memory,
+    all other nodes are reached over TCP with the destination slot in front of the payload.
+    Processes on the same machine (e.g. started by start.sh) talk over unix sockets instead of TCP,
+    the socket is named after the process: SOCKET_DIR/node-{index}.sock
+    A node is created by its config message.
+    """
+
+    def __init__(self, per_process: int = NODES_PER_PROCESS, name: str = None):
+        self.per_process = per_process
+        self.name = name if name is not None else socket.gethostname()
+        self.nodes: Dict[int, Node] = {}
+
+        # index of the process in node-{index}, None if the name has no index (e.g. a local test)
+        match = re.fullmatch(r"node-(\d+)", self.name.split(".")[0])
+        self.index: int = int(match.group(1)) if match else None
+
+        self.background_tasks = (
+            set()
+        )  # to keep a reference to background tasks, so they do not get garbage collected
+
+        # to store ips locally so not every connection needs a dns call
+        self.resolver = Resolver(ttl=60)
+
+        # one long lived connection per process of a neighbor and to the logstorage
+        self.connections = ConnectionPool(resolver=self.resolver)
+
+        # limits how many messages of a broadcast are in flight at the same time
+        self.broadcast_semaphore = asyncio.Semaphore(64)
+
+        self.loop_lag = LoopLagMonitor()
+
+    def spawn(self, coro) -> asyncio.Task:
+        """Run the coroutine as background task"""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    def owns(self, slot: int) -> bool:
+        """True if the slot belongs to the block of slots of this process"""
+        return self.index is None or slot // self.per_process == self.index
 
-        to = f"node-{neighborid}.stsservice.ma-schuetz-dcun.svc.cluster.local"
+    def get_node(self, slot: int) -> Node:
         try:
-            writer, reader = await self.send_message_to(msg=msg, to=to)
-            return neighborid, writer, reader
-        except SendingMessageError:
-            raise SendingMessageError
+            return self.nodes[slot]
+        except KeyError:
+            node = Node(self, slot)
+            self.nodes[slot] = node
+            return node
 
-    async def send_message_to_all_neighbors(self, msg: str) -> None:
-        for id in self.neighbors:
+    def get_node_address(self, slot: int) -> str:
+        host = slot // self.per_process
+        return f"node-{host}.stsservice.ma-schuetz-dcun.svc.cluster.local"
 
-            to = f"node-{id}.stsservice.ma-schuetz-dcun.svc.cluster.local"
-            try:
-                writer, _ = await self.send_message_to(msg, to=to)
+    async def start_server(self, port: int = 50000):
+        self.loop_lag.start()
+        servers = [await runtime.start_server(self.handle_connection, "0.0.0.0", port)]
 
-                await writer.drain()
-                writer.close()
-                await writer.wait_closed()
-            except SendingMessageError:
+        path = runtime.socket_path(self.name)
+        if path is not None:
+            servers.append(
+                await runtime.start_unix_server(self.handle_connection, path)
+            )
+
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+    async def send(self, to: int, msg: dict, msg_codec: int = codec.JSON) -> None:
+        """Send a message to the node in the slot "to", no response expected
+
+        Raises:
+            SendingMessageError
+        """
+        node = self.nodes.get(to)
+        if node is not None:
+            self.spawn(node.handle_message(dict(msg), Reply()))
+            return
+
+        used_codec, payload = codec.encode(msg, msg_codec)
+        connection = self.connections.get(self.get_node_address(to))
+        await connection.send(DESTINATION.pack(to) + payload, codec=used_codec)
+
+    async def request(self, to: int, msg: dict, msg_codec: int = codec.JSON) -> dict:
+        """Send a message to the node in the slot "to" and wait for the response
+
+        Raises:
+            SendingMessageError
+        """
+        node = self.nodes.get(to)
+        if node is not None:
+            future = asyncio.get_running_loop().create_future()
+            self.spawn(node.handle_message(dict(msg), LocalReply(future)))
+            try:
+                return await asyncio.wait_for(future, self.connections.timeout)
+            except asyncio.TimeoutError:
                 raise SendingMessageError
 
+        used_codec, payload = codec.encode(msg, msg_codec)
+        connection = self.connections.get(self.get_node_address(to))
+        response_codec, response = await connection.request(
+            DESTINATION.pack(to) + payload, codec=used_codec
+        )
+        try:
+            return codec.decode(response, response_codec)
+        except (ValueError, KeyError, IndexError, struct.error):
+            raise SendingMessageError
+
     async def handle_connection_task_wrapper(
         self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
     ) -> None:
@@ -189,78 +364,85 @@ class Node:
         from the set when it ends.
         """
 
-        task = asyncio.create_task(self.handle_connection(reader=reader, writer=writer))
-        self.background_tasks.add(task)
-        task.add_done_callback(self.background_tasks.discard)
+        self.spawn(self.handle_connection(reader=reader, writer=writer))
 
     async def handle_connection(
         self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
     ) -> None:
-        """Read the message from the TCP connection and call the corresponding functions.
+        """Read messages from the TCP connection until it is closed.
+
+        Other nodes keep their connection open and send length framed messages (see connection.py),
+        every frame is handled in its own task so a slow handler does not block the connection.
+        A connection starting with "{" is a single plain json message, e.g. from the controller.
+        """
+        try:
+            first = await reader.readexactly(1)
 
-        Messages are json format
+            if first == b"{":
+                data = first + await reader.read()
+                await self.handle_message(data, codec.JSON, StreamReply(writer=writer))
+                writer.close()
+                return
+
+            frames = FrameWriter(writer)
+            while True:
+                _, msg_codec, cid, payload = await read_frame(reader, prefix=first)
+                first = b""
+
+                reply = StreamReply(frames=frames, cid=cid, codec=msg_codec)
+                self.spawn(self.handle_message(payload, msg_codec, reply, framed=True))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            writer.close()
+
+    async def handle_message(
+        self, data: bytes, msg_codec: int, reply: StreamReply, framed: bool = False
+    ) -> None:
+        """Decode a message and pass it to the node it is meant for.
+
+        Messages are json format, synchronisation messages can also use the binary codec (see codec.py)
 
         every message has to contain the key "type"!
-        if "type" is "node" the message is meant to be handled by the node
-        if "type" is "synchronization" the messaged is passed to the "handle" function of the set synchronization module
+        Frames from other nodes start with the slot of the destination node,
+        plain messages name it with the keys "node_id" and "node_offset",
+        without them they go to all nodes of the process.
         """
-        data = await reader.read(2000)
-        message = data.decode()
-
         try:
-            msg_dict = json.loads(message)
-
-            if msg_dict["type"] == "node":
-                if msg_dict["operation"] == "config":
-                    self.register_new_node_config(msg_dict)
-                    self.register_synchronisation_modell(msg_dict)
-            elif (
-                msg_dict["type"] == "synchronization"
-                and self.synchronization_module is not None
-            ):
-                try:
-                    await self.synchronization_module.handle(
-                        msg=msg_dict, writer=writer
-                    )
-                except AttributeError:
-                    print("No synchronization module with handle function!")
-
-        except json.JSONDecodeError:
-            print("not json")
-            print(f"received: {message}")
-
-    def setup_local_ip_cache(self) -> None:
-        # neighbors
-        for neighbor_id in self.neighbors:
-            ip = self.get_node_ip_by_dns(neighbor_id)
-            self.local_ip_cache[neighbor_id] = ip
-
-        # logstorage
-        ip = self.get_service_ip_by_dns("logstorage")
-        self.local_ip_cache[neighbor_id] = ip
-
-    def check_local_ip_cache_entry(self, id=None, service=None) -> None:
-        if id != None:
-            ip = self.get_node_ip_by_dns(id)
-            self.local_ip_cache[id] = ip
-        if service != None:
-            ip = self.get_service_ip_by_dns(service)
-            self.local_ip_cache[service] = ip
-
-    def get_node_ip_by_dns(self, node_id) -> str:
-        return gethostbyname(
-            f"node-{node_id}.stsservice.ma-schuetz-dcun.svc.cluster.local"
-        )
+            slot = None
+            if framed:
+                (slot,) = DESTINATION.unpack_from(data)
+                data = data[DESTINATION.size :]
+
+            msg_dict = codec.decode(data, msg_codec)
+            if slot is None and "node_id" in msg_dict:
+                slot = int(msg_dict["node_id"]) + int(msg_dict.get("node_offset", 0))
+
+            if slot is None:
+                nodes = list(self.nodes.values())
+            elif msg_dict["type"] == "node":
+                if not self.owns(slot):
+                    # a second copy of the node here would never get the messages of its neighbors
+                    print(f"slot {slot} belongs to node-{slot // self.per_process}")
+                    return
+                nodes = [self.get_node(slot)]
+            elif slot in self.nodes:
+                nodes = [self.nodes[slot]]
+            else:
+                print(f"slot {slot} is not hosted here")
+                return
+
+            await asyncio.gather(*(n.handle_message(msg_dict, reply) for n in nodes))
 
-    def get_service_ip_by_dns(self, service) -> str:
-        return gethostbyname(f"{service}")
+        except (ValueError, KeyError, IndexError, struct.error):
+            print("malformed message")
+            print(f"received: {data}")
 
 
 async def main():
-    node = Node()
-    await node.start_server()
+    # in kubernetes the host name is the pod name node-{index}, start.sh passes the index
+    host = NodeHost(name=f"node-{sys.argv[1]}" if len(sys.argv) > 1 else None)
+    await host.start_server(port=NODE_PORT)
 
 
 if __name__ == "__main__":
     print("running main")
-    asyncio.run(main())
+    runtime.run(main)
@@ -0,0 +1,56 @@
+import asyncio
+from socket import AF_INET, SOCK_STREAM
+from time import monotonic
+from typing import Dict, Iterable, Tuple
+
+
+class Resolver:
+    """Caches the resolved ip of nodes and services for "ttl" seconds.
+
+    Lookups run through loop.getaddrinfo, so they never block the event loop,
+    and concurrent lookups of the same host share one DNS query.
+    """
+
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self.cache: Dict[str, Tuple[str, float]] = {}  # host: (ip, resolved at)
+        self.lookups: Dict[str, asyncio.Task] = {}  # host: running lookup
+
+    async def resolve(self, host: str) -> str:
+        """Return the ip of the host, from the cache if the entry is younger than ttl
+
+        Raises:
+            OSError: (socket.gaierror) if the host can not be resolved
+        """
+        try:
+            ip, resolved_at = self.cache[host]
+            if monotonic() - resolved_at < self.ttl:
+                return ip
+        except KeyError:
+            pass
+
+        try:
+            lookup = self.lookups[host]
+        except KeyError:
+            lookup = asyncio.create_task(self.lookup(host))
+            self.lookups[host] = lookup
+            lookup.add_done_callback(lambda _: self.lookups.pop(host, None))
+
+        return await asyncio.shield(lookup)
+
+    async def lookup(self, host: str) -> str:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, None, family=AF_INET, type=SOCK_STREAM
+        )
+        ip = infos[0][4][0]
+
+        self.cache[host] = (ip, monotonic())
+        return ip
+
+    async def prefetch(self, hosts: Iterable[str]) -> None:
+        """Resolve all hosts concurrently, failed lookups are retried on first use"""
+        await asyncio.gather(*(self.resolve(h) for h in hosts), return_exceptions=True)
+
+    def invalidate(self, host: str) -> None:
+        """Drop the entry, e.g. after a failed connection: the pod may have a new ip"""
+        self.cache.pop(host, None)
@@ -0,0 +1,141 @@
+import asyncio
+import os
+import socket
+from typing import Awaitable, Callable
+
+# listen backlog of the node server, the default of 100 is too small when many nodes connect at once
+BACKLOG: int = 1024
+
+# directory of the unix sockets of the node processes on this machine, empty to only use TCP
+SOCKET_DIR: str = os.environ.get("NODE_SOCKET_DIR", "/tmp/dcun")
+
+# NODE_EVENT_LOOP=asyncio keeps the default event loop even if uvloop is installed
+EVENT_LOOP: str = os.environ.get("NODE_EVENT_LOOP", "uvloop")
+
+
+def install_event_loop() -> str:
+    """Use uvloop as event loop if it is installed and not disabled.
+
+    Returns:
+        name of the used event loop
+    """
+    if EVENT_LOOP != "uvloop":
+        return "asyncio"
+
+    try:
+        import uvloop
+    except ImportError:
+        return "asyncio"
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
+
+
+def run(main: Callable[[], Awaitable]) -> None:
+    print(f"event loop: {install_event_loop()}")
+    asyncio.run(main())
+
+
+def set_nodelay(writer: asyncio.StreamWriter) -> None:
+    """Send small messages right away instead of waiting for more data (Nagle)"""
+    sock = writer.get_extra_info("socket")
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+async def start_server(
+    handler: Callable,
+    host: str = "0.0.0.0",
+    port: int = 50000,
+    reuse_port: bool = False,
+) -> asyncio.AbstractServer:
+    """asyncio.start_server with a large backlog, address reuse and TCP_NODELAY on every connection
+
+    reuse_port lets several processes listen on the same port and the kernel spreads the connections
+    between them. Node processes of one pod must not share their port, a second process
+    on the port has to fail instead of silently getting messages of the nodes of the first one.
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        set_nodelay(writer)
+        await handler(reader, writer)
+
+    return await asyncio.start_server(
+        handle,
+        host,
+        port,
+        backlog=BACKLOG,
+        reuse_address=True,
+        reuse_port=reuse_port and hasattr(socket, "SO_REUSEPORT"),
+    )
+
+
+def socket_path(host: str) -> str:
+    """Path of the unix socket of the process with the given host name, None if disabled
+
+    node-3.stsservice... and node-3 both map to SOCKET_DIR/node-3.sock
+    """
+    if not SOCKET_DIR:
+        return None
+    return os.path.join(SOCKET_DIR, host.split(".")[0] + ".sock")
+
+
+async def start_unix_server(handler: Callable, path: str) -> asyncio.AbstractServer:
+    """asyncio.start_unix_server with a large backlog, replaces the socket file of a stopped process"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    return await asyncio.start_unix_server(handler, path, backlog=BACKLOG)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps "interval" seconds.
+
+    A high lag means handlers block the loop, so messages are answered late
+    and the models are coupled with outdated phases and states.
+    """
+
+    def __init__(self, interval: float = 0.1, report_every: float = 30):
+        self.interval = interval
+        self.report_every = report_every
+
+        self.samples: int = 0
+        self.total: float = 0
+        self.max: float = 0
+
+        self.task: asyncio.Task = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.measure())
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.samples if self.samples else 0
+
+    def reset(self) -> None:
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+
+    async def measure(self) -> None:
+        loop = asyncio.get_running_loop()
+        last_report = loop.time()
+
+        while True:
+            before = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - before - self.interval
+
+            self.samples += 1
+            self.total += lag
+            self.max = max(self.max, lag)
+
+            if loop.time() - last_report >= self.report_every:
+                print(
+                    f"loop lag: mean {self.mean * 1000:.1f} ms, max {self.max * 1000:.1f} ms"
+                )
+                self.reset()
+                last_report = loop.time()
@@ -6,7 +6,12 @@ ps -ef | grep 'python3 node.py' | grep -v grep | awk '{print $2}' | xargs -r kil
 
 
 
-for ((i = 1 ; i <= $1 ; i++)); do
+# $1: number of nodes, $2: nodes per process (default 1)
+export NODES_PER_PROCESS=${2:-1}
+
+# process i hosts the nodes i * NODES_PER_PROCESS ... and listens on NODE_SOCKET_DIR/node-$i.sock,
+# the processes reach each other over these sockets, every process gets a TCP port of its own
+for ((i = 0 ; i < ($1 + NODES_PER_PROCESS - 1) / NODES_PER_PROCESS ; i++)); do
 	# tmux new-session \; send-keys "python3 node.py "$i" "$3"" Enter
-	python3 node.py $i &
+	NODE_PORT=$((50000 + i)) python3 node.py $i &
 done
\ No newline at end of file
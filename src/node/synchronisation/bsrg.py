@@ -1,20 +1,16 @@
 from random import randint
-from statistics import mean, StatisticsError
 
-from .interface import Synchronisation_Interface, SendingMessageError
+from .interface import BroadcastError, Reply, Synchronisation_Interface
+from .quantiser import SUM_REFRESH, Quantiser
 import asyncio
-from math import atan2, pi, cos, sin
-import json
 from time import time
 
 
-start_time: float = 0
-
-
 class BSRG(Synchronisation_Interface):
     def __init__(self, node) -> None:
         super().__init__()
         self.node = node
+        self.start_time: float = 0  # time at the start of the synchronization
 
         self.run: str = None
         self.run_time: float = None
@@ -23,7 +19,11 @@ class BSRG(Synchronisation_Interface):
         self.state: int
 
         self.neighborstates: dict = {}  # id: state
-        self.state_radiant_map: dict = {}
+        # running sums of cos and sin of the neighbor states, kept by update_neighbor_state
+        self.neighbor_cos: float = 0
+        self.neighbor_sin: float = 0
+        self.sum_updates: int = 0  # updates since the sums were last recomputed
+        self.quantiser: Quantiser = None
 
         self.dynamic_cs: bool = False
         self.gamma: int = 1
@@ -44,10 +44,7 @@ class BSRG(Synchronisation_Interface):
 
         self.max_states = int(msg["max_states"])
         self.state = randint(0, self.max_states - 1)
-        self.state_radiant_map: dict = {
-            state: ((2 * pi * state) / self.max_states)
-            for state in range(self.max_states)
-        }
+        self.quantiser = Quantiser(self.max_states)
         self.coupling_strength = float(msg["coupling_strength"])
 
         try:
@@ -62,29 +59,25 @@ class BSRG(Synchronisation_Interface):
             self.dynamic_cs = False
 
     def get_radiant_from_state(self, state: int) -> float:
-        return (2 * pi * state) / self.max_states
-
-    async def calculate_hamiltonian(self, neighborstates: dict = None) -> float:
-        if neighborstates == None:
-            neighborstates = self.neighborstates
-
-        hamiltonian: float = 0
-        for _, neighbor_state in self.neighborstates.items():
-            hamiltonian += cos(
-                self.get_radiant_from_state(self.state)
-                - self.get_radiant_from_state(neighbor_state)
-            )
-
-        return hamiltonian
+        return self.quantiser.radiants[state]
+
+    async def calculate_hamiltonian(self, my_state: int = -1) -> float:
+        """sum(cos(my_state - neighbor_state)) from the running sums of the neighbor states"""
+        if my_state == -1:
+            my_state = self.state
+
+        # cos(a - b) = cos(a) cos(b) + sin(a) sin(b)
+        q = self.quantiser
+        return (
+            q.cos_table[my_state] * self.neighbor_cos
+            + q.sin_table[my_state] * self.neighbor_sin
+        )
 
     def get_closest_state_from_rad(self, rad: float) -> int:
-        state, _ = min(self.state_radiant_map.items(), key=lambda x: abs(rad - x[1]))
-
-        return state
+        return self.quantiser.closest_state(rad)
 
     async def calculate_step_distance(self, distance: int, gamma: float = None):
-        global start_time
-        if time() - start_time < self.dynamic_time:
+        if time() - self.start_time < self.dynamic_time:
             return gamma
         else:
             max_dist: int = self.max_states // 2
@@ -93,58 +86,64 @@ class BSRG(Synchronisation_Interface):
             return max(1, (gamma * (max_dist - distance) // (max_dist - avg_dist)))
 
     async def notify_neighbors_of_new_state(self, is_initial_state: bool = False):
-        msg = json.dumps(
-            {
-                "type": "synchronization",
-                "operation": "new_neighbor-state",
-                "id": f"{self.node.id}",
-                "state": f"{int(self.state)}",
-            }
-        )
+        msg = {
+            "type": "synchronization",
+            "operation": "new_neighbor-state",
+            "id": int(self.node.id),
+            "state": int(self.state),
+        }
 
+        neighbors = None  # all neighbors
         while True:
             try:
-                await self.node.send_message_to_all_neighbors(msg)
+                await self.node.send_message_to_all_neighbors(msg, neighbors=neighbors)
                 return
-            except SendingMessageError:
-                # if is_initial_state:
+            except BroadcastError as e:
+                # only retry the neighbors that did not get the state
+                neighbors = e.failed
                 await asyncio.sleep(0.1)
                 continue
 
-    def update_neighbor_state(self, neighbor_id: str, neighbor_state: int):
+    def update_neighbor_state(self, neighbor_id: int, neighbor_state: int):
+        q = self.quantiser
+        old_state = self.neighborstates.get(neighbor_id)
         self.neighborstates[neighbor_id] = neighbor_state
+        self.sum_updates += 1
+
+        # a new neighbor or SUM_REFRESH updates: recompute instead of adding the difference
+        if old_state is None or self.sum_updates >= SUM_REFRESH:
+            self.neighbor_cos, self.neighbor_sin = q.sums(self.neighborstates.values())
+            self.sum_updates = 0
+            return
+
+        self.neighbor_cos += q.cos_table[neighbor_state] - q.cos_table[old_state]
+        self.neighbor_sin += q.sin_table[neighbor_state] - q.sin_table[old_state]
 
     async def log_task(self):
         start = time()
 
         self.logging.set()
         while self.logging.is_set():
-            self.node.history[
-                "%.2f" % (time() - start)
-            ] = (
-                self.state
-            )  # 2 digits after dot https://floating-point-gui.de/languages/python/
+            self.node.history.append(time() - start, self.state)
             await asyncio.sleep(0.1)
 
         await asyncio.sleep(3)
         await self.node.send_logs()
 
     def log_state(self):
-        global start_time
-        self.node.history["%.2f" % (time() - start_time)] = self.state
+        self.node.history.append(time() - self.start_time, self.state)
 
     async def start_synchronisation(self):
-        global start_time
 
         print(f"start synchro: {self.run}")
-        start_time = time()
+        self.start_time = time()
 
         # task = asyncio.create_task(self.log_task())
         # self.background_tasks.add(task)
         # task.add_done_callback(self.background_tasks.discard)
 
-        start_time = time()
-        while time() - start_time < self.run_time:
+        self.start_time = time()
+        while time() - self.start_time < self.run_time:
             await asyncio.sleep(randint(2, 7) / 10)
             await self.synchronization_step()
             self.log_state()
@@ -154,16 +153,9 @@ class BSRG(Synchronisation_Interface):
         await self.node.send_logs()
 
     async def synchronization_step_brute_force_hamiltonian(self):
-        calc_hamiltonians = []
-        for s in range(self.max_states):
-            hamiltonian = 0
-            for _, neighbor_state in self.neighborstates.items():
-                hamiltonian += cos(
-                    self.get_radiant_from_state(s)
-                    - self.get_radiant_from_state(neighbor_state)
-                )
-
-            calc_hamiltonians.append(hamiltonian)
+        calc_hamiltonians = [
+            await self.calculate_hamiltonian(my_state=s) for s in range(self.max_states)
+        ]
 
         state_with_lowest_hamiltonian = calc_hamiltonians.index(max(calc_hamiltonians))
 
@@ -172,25 +164,14 @@ class BSRG(Synchronisation_Interface):
     async def synchronization_step(self):
         """Look at neighbor states and find the state which minimalizes the hamiltonian"""
 
-        radians_neighbors = [
-            self.get_radiant_from_state(s) for s in self.neighborstates.values()
-        ]
-
-        x_list = []
-        y_list = []
-        for rad in radians_neighbors:
-            x_list.append(cos(rad))
-            y_list.append(sin(rad))
-
-        try:
-            average = ((2 * pi) + atan2(mean(y_list), mean(x_list))) % (2 * pi)
-        # average as a positive radian in range [0,2pi)
-        except StatisticsError as e:
-            # mean requires at least one data point
-            print(e)
+        if not self.neighborstates:
+            # the mean requires at least one neighbor state
+            print("no neighbor states")
             await asyncio.sleep(1)
             return
 
+        avg_state = self.quantiser.mean_state(self.neighbor_cos, self.neighbor_sin)
+
         if False:
             # my_rad = self.get_radiant_from_state(self.state)
             # rad annäherung
@@ -207,8 +188,6 @@ class BSRG(Synchronisation_Interface):
             # new_state = self.get_closest_state_from_rad(new_rad)
             pass
 
-        avg_state = self.get_closest_state_from_rad(average)
-
         before = self.state
 
         dist = abs(avg_state - self.state)
@@ -242,11 +221,10 @@ class BSRG(Synchronisation_Interface):
 
         await self.notify_neighbors_of_new_state()
 
-    async def handle(self, msg: dict, writer: asyncio.StreamWriter):
-        writer.close()
+    async def handle(self, msg: dict, reply: Reply):
         if msg["operation"] == "new_neighbor-state":
             self.update_neighbor_state(
-                neighbor_id=msg["id"], neighbor_state=int(msg["state"])
+                neighbor_id=int(msg["id"]), neighbor_state=int(msg["state"])
             )
         if msg["operation"] == "share_state":
             await self.notify_neighbors_of_new_state()
@@ -257,20 +235,15 @@ class BSRG(Synchronisation_Interface):
             task.add_done_callback(self.background_tasks.discard)
 
         elif msg["operation"] == "end":
-            _ = await self.handle_end_synchro(writer, msg)
-
-    async def handle_end_synchro(self, writer: asyncio.StreamWriter, msg: dict) -> None:
-        # closing writer
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
+            _ = await self.handle_end_synchro(msg)
 
+    async def handle_end_synchro(self, msg: dict) -> None:
         # END Logging by clearing event
         async with self.flooded_lck:
             self.logging.clear()
             if self.flooded_end == True:  # return early if already set
                 return None
 
-            await self.node.send_message_to_all_neighbors(json.dumps(msg))
+            await self.node.send_message_to_all_neighbors(msg)
             self.flooded_end = True
             return None
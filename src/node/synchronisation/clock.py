@@ -1,20 +1,16 @@
 from socket import gaierror
-from statistics import mean
 from time import time
-from .interface import Synchronisation_Interface, SendingMessageError
+from .interface import Reply, Synchronisation_Interface, SendingMessageError
+from .quantiser import Quantiser
 import asyncio
 from random import randint
-from math import atan2, cos, pi, sin
-import json
-
-
-start_time: float = 0
 
 
 class Clock(Synchronisation_Interface):
     def __init__(self, node) -> None:
         super().__init__()
         self.node = node
+        self.start_time: float = 0  # time at the start of the synchronization
         self.max_states: int = -1
         self.state: int = -1
         # self.coupling_strength: int = None
@@ -24,7 +20,7 @@ class Clock(Synchronisation_Interface):
         self.avg_dist: int = 100
         self.dynamic_time: float = 10
 
-        self.state_radiant_map: dict = {}
+        self.quantiser: Quantiser = None
 
         self.run: str = ""
         self.run_time: float = 30
@@ -41,10 +37,7 @@ class Clock(Synchronisation_Interface):
 
         self.max_states = int(msg["max_states"])
         self.state = randint(0, self.max_states - 1)
-        self.state_radiant_map: dict = {
-            state: ((2 * pi * state) / self.max_states)
-            for state in range(self.max_states)
-        }
+        self.quantiser = Quantiser(self.max_states)
         # self.coupling_strength = float(msg["coupling_strength"])
 
         try:
@@ -59,16 +52,13 @@ class Clock(Synchronisation_Interface):
             self.dynamic_cs = False
 
     def get_rad_from_state(self, state: int) -> float:
-        return (2 * pi * state) / self.max_states
+        return self.quantiser.radiants[state]
 
     def get_closest_state_from_rad(self, rad: float) -> int:
-        state, _ = min(self.state_radiant_map.items(), key=lambda x: abs(rad - x[1]))
-
-        return state
+        return self.quantiser.closest_state(rad)
 
     async def calculate_step_distance(self, distance: int, gamma: float = 1):
-        global start_time
-        if time() - start_time < self.dynamic_time and (not self.dynamic_cs):
+        if time() - self.start_time < self.dynamic_time and (not self.dynamic_cs):
             return gamma
         else:
             max_dist: int = self.max_states // 2
@@ -77,23 +67,16 @@ class Clock(Synchronisation_Interface):
             return max(1, (self.gamma * (max_dist - distance) // (max_dist - avg_dist)))
 
     async def calculate_and_set_new_state(self, partner_state: int) -> None:
-        global start_time
-
-        partner_rad = self.get_rad_from_state(partner_state)
-
-        average = (
-            (2 * pi)
-            + atan2(
-                mean([sin(partner_rad), sin(self.get_rad_from_state(self.state))]),
-                mean([cos(partner_rad), cos(self.get_rad_from_state(self.state))]),
-            )
-        ) % (2 * pi)
 
-        avg_state = self.get_closest_state_from_rad(average)
+        q = self.quantiser
+        avg_state = q.mean_state(
+            q.cos_table[partner_state] + q.cos_table[self.state],
+            q.sin_table[partner_state] + q.sin_table[self.state],
+        )
 
         dist = abs(avg_state - self.state)
         if dist == 0:
-            self.node.history["%.2f" % (time() - start_time)] = self.state
+            self.node.history.append(time() - self.start_time, self.state)
             return
 
         if self.dynamic_cs:
@@ -117,60 +100,41 @@ class Clock(Synchronisation_Interface):
             else:
                 self.state = int((self.state + step_distance) % self.max_states)
 
-        self.node.history["%.2f" % (time() - start_time)] = self.state
+        self.node.history.append(time() - self.start_time, self.state)
 
     async def log_task(self):
         start = time()
 
         self.logging.set()
         while self.logging.is_set():
-            self.node.history[
-                "%.2f" % (time() - start)
-            ] = (
-                self.state
-            )  # 2 digits after dot https://floating-point-gui.de/languages/python/
+            self.node.history.append(time() - start, self.state)
             await asyncio.sleep(0.05)
 
         await asyncio.sleep(10)
         await self.node.send_logs()
 
     async def start_synchronisation(self):
-        global start_time
         print(f"start {self.run}")
 
         # task = asyncio.create_task(self.log_task())
         # self.background_tasks.add(task)
         # task.add_done_callback(self.background_tasks.discard)
 
-        start_time = time()
+        self.start_time = time()
 
-        while time() - start_time < self.run_time:
+        while time() - self.start_time < self.run_time:
             await asyncio.sleep(randint(10, 20) / 100)
 
             # send my state to random neighbor
             try:
-                msg = json.dumps(
-                    {
-                        "type": "synchronization",
-                        "operation": "synchro-request",
-                        "state": self.state,
-                    }
-                )
-
-                (
-                    _,
-                    writer,
-                    reader,
-                ) = await self.node.send_message_to_random_neighbor(msg)
+                msg = {
+                    "type": "synchronization",
+                    "operation": "synchro-request",
+                    "state": self.state,
+                }
 
                 # wait for response and calculate new state
-                res = await reader.read(2000)
-                res = res.decode()
-
-                await writer.drain()
-                writer.close()
-
-                res_dict = json.loads(res)
+                _, res_dict = await self.node.request_random_neighbor(msg)
 
                 await self.calculate_and_set_new_state(int(res_dict["state"]))
             except SendingMessageError:
@@ -182,42 +146,32 @@ class Clock(Synchronisation_Interface):
         # self.logging.clear()
 
         # # flood end
-        # msg: str = json.dumps({"type": "synchronization", "operation": "end"})
+        # msg: dict = {"type": "synchronization", "operation": "end"}
         # await self.node.send_message_to_all_neighbors(msg)
         # self.flooded_end = True
 
         return
 
-    async def handle(self, msg: dict, writer: asyncio.StreamWriter):
+    async def handle(self, msg: dict, reply: Reply):
         if msg["operation"] == "start":
             task = asyncio.create_task(self.start_synchronisation())
             self.background_tasks.add(task)
             task.add_done_callback(self.background_tasks.discard)
 
-            await writer.drain()
-            writer.close()
-
         elif msg["operation"] == "synchro-request":
-            _ = await self.handle_incoming_synchro(writer=writer, msg=msg)
+            _ = await self.handle_incoming_synchro(reply=reply, msg=msg)
         elif msg["operation"] == "end":
-
             _ = await self.handle_end_synchro(msg)
-            await writer.drain()
-            writer.close()
 
-    async def handle_incoming_synchro(self, writer: asyncio.StreamWriter, msg: dict):
+    async def handle_incoming_synchro(self, reply: Reply, msg: dict):
         # answer with my state
-        response = json.dumps(
-            {
-                "type": "synchronization",
-                "operation": "synchro-response",
-                "state": self.state,
-            }
-        )
+        response = {
+            "type": "synchronization",
+            "operation": "synchro-response",
+            "state": self.state,
+        }
 
-        writer.write(response.encode())
-        await writer.drain()
-        writer.close()
+        await reply.send(response)
 
         # calculate and set new state
         await self.calculate_and_set_new_state(int(msg["state"]))
@@ -229,6 +183,6 @@ class Clock(Synchronisation_Interface):
             if self.flooded_end == True:
                 return None
 
-            await self.node.send_message_to_all_neighbors(json.dumps(msg))
+            await self.node.send_message_to_all_neighbors(msg)
             self.flooded_end = True
             return None
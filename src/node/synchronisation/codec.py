@@ -0,0 +1,74 @@
+import json
+import struct
+from typing import Dict, FrozenSet, Tuple
+
+# codec ids, sent with every frame so the receiver knows how to decode it
+JSON: int = 0
+BINARY: int = 1
+
+CODECS: Dict[str, int] = {"json": JSON, "binary": BINARY}
+
+# fixed layouts of the synchronisation messages for the binary codec
+# message id: (operation, fields, struct format of the fields)
+LAYOUTS: Dict[int, Tuple[str, Tuple[str, ...], struct.Struct]] = {
+    1: ("start", (), struct.Struct("!")),
+    2: ("end", (), struct.Struct("!")),
+    3: ("share_state", (), struct.Struct("!")),
+    # kuramoto
+    4: (
+        "synchro-request",
+        ("initiator_phase", "initiator_id", "degree"),
+        struct.Struct("!dii"),
+    ),
+    5: ("synchro-response", ("response_phase", "degree"), struct.Struct("!di")),
+    # clock
+    6: ("synchro-request", ("state",), struct.Struct("!i")),
+    7: ("synchro-response", ("state",), struct.Struct("!i")),
+    # metropolis and mypotts
+    8: ("new_neighbor-state", ("id", "state"), struct.Struct("!ii")),
+}
+
+# (operation, fields) -> message id
+LAYOUT_IDS: Dict[Tuple[str, FrozenSet[str]], int] = {
+    (operation, frozenset(fields)): msg_id
+    for msg_id, (operation, fields, _) in LAYOUTS.items()
+}
+
+
+def encode(msg: dict, codec: int = JSON) -> Tuple[int, bytes]:
+    """Encode a message with the given codec.
+
+    The binary codec only knows messages of type "synchronization" with a layout in LAYOUTS:
+    one byte message id followed by the packed fields.
+    Every other message falls back to json, e.g. the config message.
+
+    Returns:
+        the codec that was used and the encoded message
+    """
+    if codec == BINARY and msg["type"] == "synchronization":
+        keys = frozenset(k for k in msg if k not in ["type", "operation"])
+        try:
+            msg_id = LAYOUT_IDS[(msg["operation"], keys)]
+            _, fields, layout = LAYOUTS[msg_id]
+
+            return BINARY, bytes([msg_id]) + layout.pack(*(msg[f] for f in fields))
+        except KeyError:
+            pass
+
+    return JSON, json.dumps(msg).encode()
+
+
+def decode(payload: bytes, codec: int = JSON) -> dict:
+    """Decode a message encoded by "encode"
+
+    Raises:
+        ValueError, KeyError, IndexError, struct.error: if the payload is malformed
+    """
+    if codec == JSON:
+        return json.loads(payload.decode())
+
+    operation, fields, layout = LAYOUTS[payload[0]]
+
+    msg = {"type": "synchronization", "operation": operation}
+    msg.update(zip(fields, layout.unpack_from(payload, 1)))
+    return msg
@@ -7,10 +7,24 @@ class Synchronisation_Interface:
         pass
 
 
+class Reply:
+    async def send(self, msg: dict) -> None:
+        """answer the message the handle was passed with"""
+        pass
+
+
 class SendingMessageError(Exception):
     pass
 
 
+class BroadcastError(SendingMessageError):
+    """raised if a message could not be sent to some of the neighbors"""
+
+    def __init__(self, failed: list):
+        super().__init__(f"failed sending to {failed}")
+        self.failed: list = failed  # ids of the neighbors that did not get the message
+
+
 @dataclass
 class Logentry:
     run_id: int
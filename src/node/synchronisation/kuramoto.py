@@ -1,16 +1,14 @@
 from random import randint, randrange
-from .interface import SendingMessageError, Synchronisation_Interface
+from .interface import Reply, SendingMessageError, Synchronisation_Interface
 import asyncio
-import json
 from time import time
 from math import sin, pi
 
-start_time: float = 0
-
 
 class KuramotoModell(Synchronisation_Interface):
     def __init__(self, node):
         self.node = node
+        self.start_time: float = 0  # time at the start of the synchronization
         self.frequency: float = 0
         self.time_skew: float = 0
         self.run: str = ""
@@ -56,11 +54,10 @@ class KuramotoModell(Synchronisation_Interface):
         return sin(self.get_phase())
 
     def update_new_frequency(self, partner_phase: float) -> None:
-        global start_time
 
         cs: float = self.coupling_strength_f2()
 
-        if self.dynamic_cs and time() - start_time > self.dynamic_time:
+        if self.dynamic_cs and time() - self.start_time > self.dynamic_time:
 
             period: float = 1 / self.frequency
             phase_diff = self.get_phase() - partner_phase
@@ -92,37 +89,28 @@ class KuramotoModell(Synchronisation_Interface):
 
         self.logging.set()
         while self.logging.is_set():
-            self.node.history[
-                "%.2f" % (time() - start)
-            ] = (
-                self.get_signal()
-            )  # 2 digits after dot https://floating-point-gui.de/languages/python/
+            self.node.history.append(time() - start, self.get_signal())
             await asyncio.sleep(0.05)
 
         await asyncio.sleep(10)
         await self.node.send_logs()
 
-    async def handle(self, msg: dict, writer: asyncio.StreamWriter):
+    async def handle(self, msg: dict, reply: Reply):
 
         if msg["operation"] == "start":
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
-
             task = asyncio.create_task(self.handle_start_synchronisation())
             self.background_tasks.add(task)
             task.add_done_callback(self.background_tasks.discard)
 
             # await self.start_synchronisation()
         elif msg["operation"] == "synchro-request":
-            _ = await self.handle_incoming_synchro(writer, msg)
+            _ = await self.handle_incoming_synchro(reply, msg)
         elif msg["operation"] == "end":
-            _ = await self.handle_end_synchro(writer, msg)
+            _ = await self.handle_end_synchro(msg)
 
     async def handle_start_synchronisation(self):
-        global start_time
 
-        start_time = time()
+        self.start_time = time()
 
         print(f"start synchro: {self.run}")
 
@@ -130,31 +118,19 @@ class KuramotoModell(Synchronisation_Interface):
         self.background_tasks.add(task)
         task.add_done_callback(self.background_tasks.discard)
 
-        while time() - start_time < self.run_time:
+        while time() - self.start_time < self.run_time:
             await asyncio.sleep(0.1)
 
-            msg = json.dumps(
-                {
-                    "type": "synchronization",
-                    "operation": "synchro-request",
-                    "initiator_phase": self.get_phase(),
-                    "initiator_id": self.node.id,
-                    "degree": self.node.degree,
-                }
-            )
+            msg = {
+                "type": "synchronization",
+                "operation": "synchro-request",
+                "initiator_phase": self.get_phase(),
+                "initiator_id": self.node.id,
+                "degree": self.node.degree,
+            }
 
             try:
-                (
-                    _,
-                    writer,
-                    reader,
-                ) = await self.node.send_message_to_random_neighbor(msg)
-
-                data = await reader.read(2000)
-                res = data.decode()
-
-                writer.close()
-                res_dict = json.loads(res)
+                _, res_dict = await self.node.request_random_neighbor(msg)
 
                 self.update_new_frequency(partner_phase=res_dict["response_phase"])
             except SendingMessageError:
@@ -163,42 +139,30 @@ class KuramotoModell(Synchronisation_Interface):
         self.logging.clear()
 
         # flood end
-        msg: str = json.dumps({"type": "synchronization", "operation": "end"})
+        msg: dict = {"type": "synchronization", "operation": "end"}
         await self.node.send_message_to_all_neighbors(msg)
         self.flooded_end = True
 
-    async def handle_incoming_synchro(
-        self, writer: asyncio.StreamWriter, msg: dict
-    ) -> None:
+    async def handle_incoming_synchro(self, reply: Reply, msg: dict) -> None:
         async with self.handling_incoming_synchro_lck:
-            response = json.dumps(
-                {
-                    "type": "synchronization",
-                    "operation": "synchro-response",
-                    "response_phase": self.get_phase(),
-                    "degree": self.node.degree,
-                }
-            )
+            response = {
+                "type": "synchronization",
+                "operation": "synchro-response",
+                "response_phase": self.get_phase(),
+                "degree": self.node.degree,
+            }
 
             self.update_new_frequency(partner_phase=float(msg["initiator_phase"]))
 
-            writer.write(response.encode())
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
-
-    async def handle_end_synchro(self, writer: asyncio.StreamWriter, msg: dict) -> None:
-        # closing writer
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
+            await reply.send(response)
 
+    async def handle_end_synchro(self, msg: dict) -> None:
         # END Logging by clearing event
         async with self.flooded_lck:
             self.logging.clear()
             if self.flooded_end == True:  # return early if alreaddy
                 return None
 
-            await self.node.send_message_to_all_neighbors(json.dumps(msg))
+            await self.node.send_message_to_all_neighbors(msg)
             self.flooded_end = True
             return None
@@ -1,23 +1,27 @@
 from random import randint, uniform
-from statistics import StatisticsError, mean
-from .interface import Synchronisation_Interface, SendingMessageError
+from .interface import BroadcastError, Reply, Synchronisation_Interface
+from .quantiser import SUM_REFRESH, Quantiser
 import asyncio
-from math import atan2, pi, cos, exp, sin
-import json
+from math import exp
 from time import time
 
 k: float = 1.380649e-23
-start_time = None  # used to store the time at the start of the synchronization
 
 
 class MetroHasting(Synchronisation_Interface):
     def __init__(self, node) -> None:
         super().__init__()
         self.node = node
+        self.start_time: float = None  # time at the start of the synchronization
 
         self.max_states: int
         self.state: int
         self.neighborstates: dict = {}  # id: state
+        # running sums of cos and sin of the neighbor states, kept by update_neighbor_state
+        self.neighbor_cos: float = 0
+        self.neighbor_sin: float = 0
+        self.sum_updates: int = 0  # updates since the sums were last recomputed
+        self.quantiser: Quantiser = None
 
         self.temperature: float = None
         self.background_tasks = set()  # needed cause asyncio is :(
@@ -28,10 +32,7 @@ class MetroHasting(Synchronisation_Interface):
     def register_new_config(self, msg: dict) -> None:
         self.max_states = int(msg["max_states"])
         self.state = randint(0, self.max_states - 1)
-        self.state_radiant_map: dict = {
-            state: ((2 * pi * state) / self.max_states)
-            for state in range(self.max_states)
-        }
+        self.quantiser = Quantiser(self.max_states)
         self.temperature = float(msg["temperature"])
         self.run = msg["run"]
         self.run_time = float(msg["time"])
@@ -44,77 +45,82 @@ class MetroHasting(Synchronisation_Interface):
             self.use_random_neighbor_state = False
 
     def get_radiant_from_state(self, state: int) -> float:
-        return (2 * pi * state) / self.max_states
+        return self.quantiser.radiants[state]
 
     def get_closest_state_from_rad(self, rad: float) -> int:
-        state, _ = min(self.state_radiant_map.items(), key=lambda x: abs(rad - x[1]))
-
-        return state
+        return self.quantiser.closest_state(rad)
 
-    async def calculate_hamiltonian(
-        self, neighborstates: dict = None, my_state: int = -1
-    ) -> float:
-
-        if neighborstates == None:
-            neighborstates = self.neighborstates
+    async def calculate_hamiltonian(self, my_state: int = -1) -> float:
+        """-sum(cos(my_state - neighbor_state)) from the running sums of the neighbor states"""
         if my_state == -1:
             my_state = self.state
 
-        hamiltonian: float = 0
-        for _, neighbor_state in self.neighborstates.items():
-            hamiltonian += cos(
-                self.get_radiant_from_state(my_state)
-                - self.get_radiant_from_state(neighbor_state)
-            )
+        # cos(a - b) = cos(a) cos(b) + sin(a) sin(b)
+        q = self.quantiser
+        hamiltonian: float = (
+            q.cos_table[my_state] * self.neighbor_cos
+            + q.sin_table[my_state] * self.neighbor_sin
+        )
 
-        hamiltonian *= -1
+        return -hamiltonian
 
-        return hamiltonian
+    def delta_hamiltonian(self, new_state: int) -> float:
+        """change of the hamiltonian if the state changed to new_state"""
+        q = self.quantiser
+        cos_change = q.cos_table[self.state] - q.cos_table[new_state]
+        sin_change = q.sin_table[self.state] - q.sin_table[new_state]
+        return cos_change * self.neighbor_cos + sin_change * self.neighbor_sin
 
     async def notify_neighbors_of_new_state(self):
 
-        msg = json.dumps(
-            {
-                "type": "synchronization",
-                "operation": "new_neighbor-state",
-                "id": f"{self.node.id}",
-                "state": f"{self.state}",
-            }
-        )
+        msg = {
+            "type": "synchronization",
+            "operation": "new_neighbor-state",
+            "id": int(self.node.id),
+            "state": int(self.state),
+        }
 
+        neighbors = None  # all neighbors
         while True:
             try:
-                await self.node.send_message_to_all_neighbors(msg)
+                await self.node.send_message_to_all_neighbors(msg, neighbors=neighbors)
                 return
-            except SendingMessageError:
-                # if is_initial_state:
+            except BroadcastError as e:
+                # only retry the neighbors that did not get the state
+                neighbors = e.failed
                 await asyncio.sleep(0.2)
                 continue
 
     def update_neighbor_state(self, neighbor_id: int, neighbor_state: int):
+        q = self.quantiser
+        old_state = self.neighborstates.get(neighbor_id)
         self.neighborstates[neighbor_id] = neighbor_state
+        self.sum_updates += 1
+
+        # a new neighbor or SUM_REFRESH updates: recompute instead of adding the difference
+        if old_state is None or self.sum_updates >= SUM_REFRESH:
+            self.neighbor_cos, self.neighbor_sin = q.sums(self.neighborstates.values())
+            self.sum_updates = 0
+            return
+
+        self.neighbor_cos += q.cos_table[neighbor_state] - q.cos_table[old_state]
+        self.neighbor_sin += q.sin_table[neighbor_state] - q.sin_table[old_state]
 
     async def log_task(self):
         start = time()
 
         self.logging.set()
         while self.logging.is_set():
-            self.node.history[
-                "%.2f" % (time() - start)
-            ] = (
-                self.state
-            )  # 2 digits after dot https://floating-point-gui.de/languages/python/
+            self.node.history.append(time() - start, self.state)
             await asyncio.sleep(0.05)
 
         await asyncio.sleep(3)
         await self.node.send_logs()
 
     def log_state(self):
-        global start_time
-        self.node.history["%.2f" % (time() - start_time)] = self.state
+        self.node.history.append(time() - self.start_time, self.state)
 
     async def start_synchronisation(self):
-        global start_time
 
         await self.notify_neighbors_of_new_state()
 
@@ -123,8 +129,8 @@ class MetroHasting(Synchronisation_Interface):
         # task = asyncio.create_task(self.log_task())
         # self.background_tasks.add(task)
         # task.add_done_callback(self.background_tasks.discard)
-        start_time = time()
-        while time() - start_time < self.run_time:
+        self.start_time = time()
+        while time() - self.start_time < self.run_time:
             await asyncio.sleep(randint(2, 7) / 10)
             await self.synchronisation_step()
 
@@ -134,8 +140,6 @@ class MetroHasting(Synchronisation_Interface):
         """m algo: random state: accept if new hamiltonian is lower"""
         global k
 
-        cur_hamiltonian: float = await self.calculate_hamiltonian()
-
         # Brute Force Hamiltonians
 
         # if self.use_random_neighbor_state:
@@ -157,30 +161,15 @@ class MetroHasting(Synchronisation_Interface):
         #     )
 
         # Efficient method for vector Potts model
-        radians_neighbors = [
-            self.get_radiant_from_state(s) for s in self.neighborstates.values()
-        ]
-
-        x_list = []
-        y_list = []
-        for rad in radians_neighbors:
-            x_list.append(cos(rad))
-            y_list.append(sin(rad))
-
-        try:
-            average = ((2 * pi) + atan2(mean(y_list), mean(x_list))) % (2 * pi)
-        # average as a positive radian in range [0,2pi)
-        except StatisticsError as e:
-            # mean requires at least one data point
-            print(e)
+        if not self.neighborstates:
+            # the mean requires at least one neighbor state
+            print("no neighbor states")
             await asyncio.sleep(1)
             return
 
-        avg_state = self.get_closest_state_from_rad(average)
+        avg_state = self.quantiser.mean_state(self.neighbor_cos, self.neighbor_sin)
 
-        new_hamiltonian: float = await self.calculate_hamiltonian(my_state=avg_state)
-
-        delta_h: float = new_hamiltonian - cur_hamiltonian
+        delta_h: float = self.delta_hamiltonian(avg_state)
 
         if delta_h <= 0:
             self.state = avg_state
@@ -201,9 +190,7 @@ class MetroHasting(Synchronisation_Interface):
 
         self.log_state()
 
-    async def handle(self, msg: dict, writer: asyncio.StreamWriter):
-        writer.close()
-
+    async def handle(self, msg: dict, reply: Reply):
         if msg["operation"] == "new_neighbor-state":
             self.update_neighbor_state(
                 neighbor_id=int(msg["id"]), neighbor_state=int(msg["state"])
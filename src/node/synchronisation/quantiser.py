@@ -0,0 +1,42 @@
+from math import atan2, ceil, cos, fsum, pi, sin
+from typing import Iterable, Tuple
+
+# running sums of cos and sin are recomputed from the states after this many updates,
+# so the rounding errors of adding and subtracting do not pile up over long runs
+SUM_REFRESH: int = 1000
+
+
+class Quantiser:
+    """Maps angles to the nearest of "max_states" states spread evenly around the circle.
+
+    State s sits at the radiant 2 * pi * s / max_states. The nearest state is found by rounding,
+    so a lookup costs the same for any number of states, and the distance is circular:
+    an angle just below 2 * pi belongs to state 0, not to state max_states - 1.
+    cos and sin of every state are computed once for the hamiltonian and the averaging.
+    """
+
+    def __init__(self, max_states: int):
+        self.max_states = max_states
+        self.step: float = (2 * pi) / max_states  # radiants between two states
+
+        self.radiants: list[float] = [
+            (2 * pi * s) / max_states for s in range(max_states)
+        ]
+        self.cos_table: list[float] = [cos(r) for r in self.radiants]
+        self.sin_table: list[float] = [sin(r) for r in self.radiants]
+
+    def closest_state(self, rad: float) -> int:
+        """nearest state to an angle in radiants (any range), ties go to the lower state"""
+        return ceil(rad / self.step - 0.5) % self.max_states
+
+    def mean_state(self, x: float, y: float) -> int:
+        """nearest state to the mean angle of states whose cos sum up to x and sin to y"""
+        return self.closest_state(atan2(y, x))
+
+    def sums(self, states: Iterable[int]) -> Tuple[float, float]:
+        """exact sums of cos and sin of the states"""
+        states = list(states)
+        return (
+            fsum(self.cos_table[s] for s in states),
+            fsum(self.sin_table[s] for s in states),
+        )
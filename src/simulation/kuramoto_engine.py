@@ -0,0 +1,202 @@
+from argparse import ArgumentParser
+from configparser import ConfigParser
+from math import pi
+from time import time as wall_time
+from typing import Iterator, Tuple
+
+import numpy as np
+import scipy.sparse
+
+from runs import chunk_rows, read_adjacency, read_config, store_run_chunks
+
+
+def init_argparse() -> ArgumentParser:
+    parser = ArgumentParser(
+        usage="%(prog)s [OPTION] config.ini ...",
+        description="run kuramoto .ini files with all nodes in numpy arrays",
+    )
+    parser.add_argument("configs", nargs="+")
+    parser.add_argument("-o", "--out_dir", default="./runs/")
+    parser.add_argument("-c", "--csv_dir")  # also export the wide csv of every run
+    parser.add_argument("-s", "--seed", type=int)
+    parser.add_argument("--step", type=float, default=0.1)
+    parser.add_argument("--log_interval", type=float, default=0.05)
+
+    return parser
+
+
+class KuramotoEngine:
+    """The Kuramoto model of synchronisation/kuramoto.py for a whole network at once.
+
+    Phase, period and time skew of every node are numpy arrays.
+    Every step each node picks a random neighbor from the CSR adjacency, and like a synchro-request
+    and its response, both nodes of every pair update their period with the phase of the other.
+    All pairs of a step are updated in one vectorised pass from the phases at the start of the step,
+    the updates of a node that was picked by several neighbors add up.
+
+    Times are seconds since the start of the synchronisation.
+    """
+
+    def __init__(
+        self,
+        adjacency: scipy.sparse.csr_array,
+        frequency: np.ndarray,
+        c: np.ndarray,
+        run_time: float = 30,
+        dynamic: bool = False,
+        dynamic_time: float = 10,
+        step: float = 0.1,
+        log_interval: float = 0.05,
+        seed: int = None,
+    ):
+        self.rng = np.random.default_rng(seed)
+
+        self.indptr: np.ndarray = adjacency.indptr
+        self.indices: np.ndarray = adjacency.indices
+        self.degree: np.ndarray = np.diff(adjacency.indptr)
+        self.initiators: np.ndarray = np.flatnonzero(
+            self.degree
+        )  # nodes with neighbors
+
+        self.period: np.ndarray = 1 / np.asarray(frequency, dtype=np.float64)
+        self.time_skew: np.ndarray = self.rng.integers(
+            0, 500, len(self.degree), endpoint=True
+        ).astype(np.float64)
+
+        # coupling_strength_f2: C / degree
+        self.cs: np.ndarray = np.divide(
+            c, self.degree, out=np.zeros(len(self.degree)), where=self.degree > 0
+        )
+
+        self.run_time = run_time
+        self.dynamic = dynamic
+        self.dynamic_time = dynamic_time
+        self.step = step
+        self.log_interval = log_interval
+
+    @classmethod
+    def from_config(
+        cls, config: ConfigParser, **kwargs
+    ) -> Tuple[list, "KuramotoEngine"]:
+        """Create the engine for an .ini of create_config.py
+
+        Returns:
+            the node ids, in the order of the arrays of the engine, and the engine
+        """
+        node_ids, adjacency = read_adjacency(config)
+        sections = [config[str(n)] for n in node_ids]
+        first = sections[0]
+
+        dynamic = first.get("dynamic") == "True"
+        engine = cls(
+            adjacency=adjacency,
+            frequency=np.array([float(s["frequency"]) for s in sections]),
+            c=np.array([float(s["c"]) for s in sections]),
+            run_time=float(first["time"]),
+            dynamic=dynamic,
+            dynamic_time=float(first["dynamic_time"]) if dynamic else 10,
+            **kwargs,
+        )
+        return node_ids, engine
+
+    def phase(self, t: float) -> np.ndarray:
+        return ((t + self.time_skew) % self.period) * 2 * pi / self.period
+
+    def random_neighbors(self) -> np.ndarray:
+        """one random neighbor for every initiator"""
+        offsets = (
+            self.rng.random(len(self.initiators)) * self.degree[self.initiators]
+        ).astype(np.int64)
+        return self.indices[self.indptr[self.initiators] + offsets]
+
+    def period_change(
+        self, sin_diff: np.ndarray, cs: np.ndarray, t: float
+    ) -> np.ndarray:
+        """update_new_frequency for sin(own phase - partner phase)"""
+        if self.dynamic and t > self.dynamic_time:
+            return cs * (1 - np.abs(sin_diff)) * np.sign(sin_diff)
+        return cs * sin_diff
+
+    def synchronisation_step(self, t: float) -> None:
+        initiators = self.initiators
+        partners = self.random_neighbors()
+
+        phase = self.phase(t)
+        sin_diff = np.sin(phase[initiators] - phase[partners])
+
+        change = np.zeros(len(self.period))
+        # the initiator updates with the phase of the response, the partner with the phase of the request
+        np.add.at(
+            change, initiators, self.period_change(sin_diff, self.cs[initiators], t)
+        )
+        np.add.at(change, partners, self.period_change(-sin_diff, self.cs[partners], t))
+
+        self.period += change
+
+    def run_chunks(self, rows: int = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Run the synchronisation for run_time seconds, logging the signal of every node like log_task
+
+        Args:
+            rows: log times per chunk, see runs.chunk_rows() for the default
+
+        Yields:
+            the log times of a chunk and the signals, one row per log time and one column per node
+        """
+        log_times = np.arange(0, self.run_time, self.log_interval)
+        if rows is None:
+            rows = chunk_rows(len(self.period))
+
+        steps = 1
+        for first in range(0, len(log_times), rows):
+            chunk = log_times[first : first + rows]
+            signals = np.empty((len(chunk), len(self.period)))
+
+            for i, t in enumerate(chunk):
+                while steps * self.step <= t:
+                    self.synchronisation_step(steps * self.step)
+                    steps += 1
+                signals[i] = np.sin(self.phase(t))
+
+            yield chunk, signals
+
+    def run(self) -> Tuple[np.ndarray, np.ndarray]:
+        """run_chunks() in one piece
+
+        Returns:
+            the log times and the signals, one row per log time and one column per node
+        """
+        chunks = list(self.run_chunks())
+        return (
+            np.concatenate([times for times, _ in chunks] or [np.empty(0)]),
+            np.concatenate(
+                [signals for _, signals in chunks] or [np.empty((0, len(self.period)))]
+            ),
+        )
+
+
+def main():
+    parser = init_argparse()
+    args = parser.parse_args()
+
+    for i, config_file in enumerate(args.configs):
+        start = wall_time()
+        config, run_id = read_config(config_file)
+
+        node_ids, engine = KuramotoEngine.from_config(
+            config,
+            step=args.step,
+            log_interval=args.log_interval,
+            seed=None if args.seed is None else args.seed + i,
+        )
+        store_run_chunks(
+            run_id,
+            node_ids,
+            engine.run_chunks(),
+            out_dir=args.out_dir,
+            csv_dir=args.csv_dir,
+        )
+        print(f"{run_id}: {len(node_ids)} nodes in {wall_time() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import os
+import sys
+from argparse import ArgumentParser
+from configparser import ConfigParser
+from time import time as wall_time
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import scipy.sparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "node"))
+
+from runs import chunk_rows, read_adjacency, read_config, store_run_chunks
+from synchronisation.quantiser import Quantiser
+
+# Boltzmann constant, as in synchronisation/metrohasting.py
+k: float = 1.380649e-23
+
+# seconds between two steps of a node: mean of the random sleep of the models
+STEP = {"mypotts": 0.45, "metropolis": 0.45, "clock": 0.15}
+
+
+def init_argparse() -> ArgumentParser:
+    parser = ArgumentParser(
+        usage="%(prog)s [OPTION] config.ini ...",
+        description="run mypotts, metropolis and clock .ini files with all states in a numpy array",
+    )
+    parser.add_argument("configs", nargs="+")
+    parser.add_argument("-o", "--out_dir", default="./runs/")
+    parser.add_argument("-c", "--csv_dir")  # also export the wide csv of every run
+    parser.add_argument("-s", "--seed", type=int)
+    parser.add_argument("--order", default="sync", choices=["sync", "async"])
+    parser.add_argument("--step", type=float)  # default: STEP of the model
+
+    return parser
+
+
+class PottsEngine:
+    """The state models BSRG (mypotts), MetroHasting (metropolis) and Clock for a whole network at once.
+
+    The states of all nodes are one integer vector. For BSRG and MetroHasting the circular mean
+    of every neighborhood comes from one sparse product of the adjacency with the cos and sin
+    of the states. Clock averages with one random neighbor, and like a synchro-request and its
+    response both nodes of the pair step towards their mean.
+    The step rules (step distance, wrap, Metropolis acceptance) are those of the models,
+    only a mean exactly between two states may round to the other one.
+
+    Update orders:
+        sync:   every node updates once per step from the states at the start of the step
+        async:  the nodes update one after another in random order and see the newest states,
+                updates that do not depend on each other are applied together (see rounds())
+
+    Times are seconds since the start of the synchronisation.
+    """
+
+    def __init__(
+        self,
+        adjacency: scipy.sparse.csr_array,
+        max_states: int,
+        model: str = "mypotts",
+        run_time: float = 30,
+        dynamic: bool = False,
+        gamma: int = 1,
+        dynamic_time: float = 10,
+        temperature: float = None,
+        order: str = "sync",
+        step: float = None,
+        seed: int = None,
+    ):
+        self.rng = np.random.default_rng(seed)
+
+        self.adjacency = adjacency
+        self.degree: np.ndarray = np.diff(adjacency.indptr)
+        self.max_states = max_states
+        self.model = model
+        self.run_time = run_time
+        self.dynamic = dynamic
+        self.gamma = gamma
+        self.dynamic_time = dynamic_time
+        self.temperature = temperature
+        self.order = order
+        self.step = step if step is not None else STEP[model]
+
+        self.state: np.ndarray = self.rng.integers(0, max_states, len(self.degree))
+
+        self.quantiser = Quantiser(max_states)
+        self.cos_table: np.ndarray = np.array(self.quantiser.cos_table)
+        self.sin_table: np.ndarray = np.array(self.quantiser.sin_table)
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, **kwargs) -> Tuple[list, "PottsEngine"]:
+        """Create the engine for an .ini of create_config.py
+
+        Returns:
+            the node ids, in the order of the state vector, and the engine
+        """
+        node_ids, adjacency = read_adjacency(config)
+        section = config[str(node_ids[0])]
+
+        dynamic = section.get("dynamic") == "True"
+        engine = cls(
+            adjacency=adjacency,
+            max_states=int(section["max_states"]),
+            model=section["synchronization_model"],
+            run_time=float(section["time"]),
+            dynamic=dynamic,
+            gamma=int(section["gamma"]) if dynamic else 1,
+            dynamic_time=float(section["dynamic_time"]) if dynamic else 10,
+            temperature=float(section.get("temperature", 0)),
+            **kwargs,
+        )
+        return node_ids, engine
+
+    def closest_state(self, rad: np.ndarray) -> np.ndarray:
+        """Quantiser.closest_state for arrays"""
+        states = np.ceil(rad / self.quantiser.step - 0.5).astype(np.int64)
+        return states % self.max_states
+
+    def mean_state(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """state closest to the circular mean with the summed cos x and sin y"""
+        return self.closest_state(np.arctan2(y, x))
+
+    def neighbor_sums(self, nodes: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """sum of cos and sin of the neighbor states of the nodes (all if None)"""
+        adjacency = self.adjacency if nodes is None else self.adjacency[nodes]
+        return (
+            adjacency @ self.cos_table[self.state],
+            adjacency @ self.sin_table[self.state],
+        )
+
+    def step_distance(self, dist: np.ndarray, t: float) -> np.ndarray:
+        """calculate_step_distance of BSRG and Clock for the distances to the target states"""
+        if not self.dynamic:
+            return np.full(len(dist), 1 if self.model == "mypotts" else self.gamma)
+
+        max_dist: int = self.max_states // 2
+        if self.model == "mypotts":
+            if t < self.dynamic_time:
+                return np.full(len(dist), self.gamma)
+            avg_dist = max_dist // 2
+        else:
+            avg_dist = max_dist * 0.2
+
+        distance = dist % max_dist
+        return np.maximum(
+            1, (self.gamma * (max_dist - distance) // (max_dist - avg_dist))
+        )
+
+    def move_step(self, state: np.ndarray, target: np.ndarray, t: float) -> np.ndarray:
+        """signed step from the states towards the targets, the short way around the circle"""
+        dist = np.abs(target - state)
+        step = np.minimum(self.step_distance(dist, t), dist)
+
+        no_wrap = dist < self.max_states / 2
+        up = (state < target) == no_wrap
+        return np.where(up, step, -step)
+
+    def move(self, state: np.ndarray, target: np.ndarray, t: float) -> np.ndarray:
+        """step from the states towards the targets"""
+        return ((state + self.move_step(state, target, t)) % self.max_states).astype(
+            np.int64
+        )
+
+    def metropolis(
+        self, state: np.ndarray, target: np.ndarray, x: np.ndarray, y: np.ndarray
+    ) -> np.ndarray:
+        """accept the targets if they lower the hamiltonian -sum(cos(own - neighbor)),
+        otherwise with the probability exp(-delta_h / (k * temperature))"""
+        delta_h = (
+            self.cos_table[state] * x
+            + self.sin_table[state] * y
+            - self.cos_table[target] * x
+            - self.sin_table[target] * y
+        )
+        with np.errstate(divide="ignore", over="ignore", invalid="ignore"):
+            chance = np.exp(-delta_h / (k * self.temperature))
+        accept = (delta_h <= 0) | (self.rng.random(len(state)) < np.minimum(1, chance))
+        return np.where(accept, target, state)
+
+    def update(self, nodes: np.ndarray, t: float) -> np.ndarray:
+        """new BSRG or MetroHasting states of the nodes from the current state vector"""
+        state = self.state[nodes]
+
+        x, y = self.neighbor_sums(nodes)
+        target = self.mean_state(x, y)
+
+        if self.model == "metropolis":
+            return self.metropolis(state, target, x, y)
+        return self.move(state, target, t)
+
+    def random_neighbors(self, nodes: np.ndarray) -> np.ndarray:
+        """one random neighbor for every node"""
+        offsets = (self.rng.random(len(nodes)) * self.degree[nodes]).astype(np.int64)
+        return self.adjacency.indices[self.adjacency.indptr[nodes] + offsets]
+
+    def clock_update(
+        self, initiators: np.ndarray, partners: np.ndarray, t: float
+    ) -> None:
+        """Both nodes of every pair step towards the mean of their two states,
+        like Clock after a synchro-request (initiator) and its response (partner).
+        The steps of a node that is in several pairs add up."""
+        own = self.state[initiators]
+        other = self.state[partners]
+        target = self.mean_state(
+            self.cos_table[own] + self.cos_table[other],
+            self.sin_table[own] + self.sin_table[other],
+        )
+
+        change = np.zeros(len(self.state), dtype=np.int64)
+        np.add.at(change, initiators, self.move_step(own, target, t))
+        np.add.at(change, partners, self.move_step(other, target, t))
+        self.state = (self.state + change) % self.max_states
+
+    def rounds(
+        self, first: np.ndarray, second: np.ndarray, rank: np.ndarray
+    ) -> List[np.ndarray]:
+        """Split updates in the random order "rank" into rounds that can be applied at once.
+
+        first[i] and second[i] are two updates that touch the same node, the one that comes later
+        in the order has to see the result of the other one, so it goes into a later round.
+        Applying the rounds one after another gives the same states as applying the updates
+        one by one in the order.
+
+        Returns:
+            the indices of the updates of every round
+        """
+        pairs = first != second
+        first, second = first[pairs], second[pairs]
+        before = np.where(rank[first] < rank[second], first, second)
+        after = np.where(rank[first] < rank[second], second, first)
+
+        # round of an update: length of the longest chain of earlier updates it depends on
+        level = np.zeros(len(rank), dtype=np.int64)
+        while True:
+            following = level.copy()
+            np.maximum.at(following, after, level[before] + 1)
+            if np.array_equal(following, level):
+                break
+            level = following
+
+        order = np.argsort(level, kind="stable")
+        return np.split(order, np.flatnonzero(np.diff(level[order])) + 1)
+
+    def synchronisation_step(self, t: float) -> None:
+        nodes = np.flatnonzero(self.degree)  # nodes without neighbors have no mean
+
+        if self.model == "clock":
+            partners = self.random_neighbors(nodes)
+            if self.order == "sync":
+                self.clock_update(nodes, partners, t)
+                return
+
+            # the updates of all pairs that share a node, in the order of the pairs
+            rank = self.rng.permutation(len(nodes))
+            updates = np.tile(np.arange(len(nodes)), 2)
+            touched = np.concatenate((nodes, partners))
+            order = np.lexsort((rank[updates], touched))
+            same = touched[order[1:]] == touched[order[:-1]]
+            first, second = updates[order[:-1]][same], updates[order[1:]][same]
+
+            for batch in self.rounds(first, second, rank):
+                self.clock_update(nodes[batch], partners[batch], t)
+            return
+
+        if self.order == "sync":
+            self.state[nodes] = self.update(nodes, t)
+            return
+
+        # a node depends on its neighbors, updates are indices into nodes
+        position = np.cumsum(self.degree > 0) - 1
+        rows = np.repeat(np.arange(len(self.degree)), self.degree)
+        rank = self.rng.permutation(len(nodes))
+        for batch in self.rounds(
+            position[rows], position[self.adjacency.indices], rank
+        ):
+            self.state[nodes[batch]] = self.update(nodes[batch], t)
+
+    def run_chunks(self, rows: int = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Run the synchronisation for run_time seconds, logging the states after every step
+
+        Args:
+            rows: log times per chunk, see runs.chunk_rows() for the default
+
+        Yields:
+            the log times of a chunk and the states, one row per log time and one column per node
+        """
+        times = np.arange(0, self.run_time, self.step)
+        if rows is None:
+            rows = chunk_rows(len(self.state))
+
+        for first in range(0, len(times), rows):
+            chunk = times[first : first + rows]
+            states = np.empty((len(chunk), len(self.state)))
+
+            for i, t in enumerate(chunk):
+                if first + i > 0:  # the first log time has the initial states
+                    self.synchronisation_step(t)
+                states[i] = self.state
+
+            yield chunk, states
+
+    def run(self) -> Tuple[np.ndarray, np.ndarray]:
+        """run_chunks() in one piece
+
+        Returns:
+            the log times and the states, one row per log time and one column per node
+        """
+        chunks = list(self.run_chunks())
+        return (
+            np.concatenate([times for times, _ in chunks] or [np.empty(0)]),
+            np.concatenate(
+                [states for _, states in chunks] or [np.empty((0, len(self.state)))]
+            ),
+        )
+
+
+def main():
+    parser = init_argparse()
+    args = parser.parse_args()
+
+    for i, config_file in enumerate(args.configs):
+        start = wall_time()
+        config, run_id = read_config(config_file)
+
+        node_ids, engine = PottsEngine.from_config(
+            config,
+            order=args.order,
+            step=args.step,
+            seed=None if args.seed is None else args.seed + i,
+        )
+        store_run_chunks(
+            run_id,
+            node_ids,
+            engine.run_chunks(),
+            out_dir=args.out_dir,
+            csv_dir=args.csv_dir,
+        )
+        print(f"{run_id}: {len(node_ids)} nodes in {wall_time() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import os
+import sys
+from configparser import ConfigParser
+from typing import Iterable, List, Tuple
+
+import networkx as nx
+import numpy as np
+import scipy.sparse
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "logstorage")
+)
+
+from storage import SegmentStore
+
+# samples an engine keeps in memory before they are stored, 2**22 doubles are 32 MB
+CHUNK_SAMPLES: int = 2**22
+
+
+def read_config(config_file: str) -> Tuple[ConfigParser, str]:
+    """Read an .ini of create_config.py
+
+    Returns:
+        the config and the run id, the name of the file without ".ini" like in controller/control.py
+    """
+    config = ConfigParser()
+    config.read(config_file)
+    return config, os.path.basename(config_file)[:-4]
+
+
+def read_adjacency(config: ConfigParser) -> Tuple[List[int], scipy.sparse.csr_array]:
+    """Build the adjacency of the graph of the run in CSR format
+
+    Returns:
+        the node ids and the adjacency, row and column i belong to node_ids[i]
+    """
+    G: nx.Graph = nx.parse_graphml(config["DEFAULT"]["graph"])
+    G: nx.Graph = nx.relabel_nodes(
+        G, lambda n: int(n[1:] if "n" in n else n)
+    )  # i graph names nodes n0, n1 etc: remove leading n
+
+    node_ids = sorted(G.nodes)
+    adjacency = nx.to_scipy_sparse_array(
+        G, nodelist=node_ids, weight=None, dtype=np.float64, format="csr"
+    )
+    return node_ids, adjacency
+
+
+def chunk_rows(nodes: int) -> int:
+    """number of log times of a chunk of an engine, so a chunk holds about CHUNK_SAMPLES samples"""
+    return max(1, CHUNK_SAMPLES // max(1, nodes))
+
+
+def store_run(
+    run_id: str,
+    columns: Iterable[Tuple[int, np.ndarray, np.ndarray]],
+    out_dir: str = "./runs/",
+    csv_dir: str = None,
+    resolution: float = 0.01,
+) -> None:
+    """Store the histories of a simulated run like the logstorage stores a real run,
+    older results of the run are replaced.
+
+    Args:
+        columns: node id, times and values of every node
+        csv_dir: if set, the wide csv of the run is exported to this directory
+    """
+    store = SegmentStore(root=out_dir)
+    store.clear(run_id)
+
+    # one manifest write for the whole run, without fsync: the run can be simulated again
+    store.append_many(
+        run_id,
+        (
+            (node_id, 0, times, values, True, resolution)
+            for node_id, times, values in columns
+        ),
+        sync=False,
+    )
+
+    export_run(store, run_id, csv_dir)
+
+
+def store_run_chunks(
+    run_id: str,
+    node_ids: List[int],
+    chunks: Iterable[Tuple[np.ndarray, np.ndarray]],
+    out_dir: str = "./runs/",
+    csv_dir: str = None,
+    resolution: float = 0.01,
+) -> None:
+    """store_run() for the output of an engine that comes in chunks of log times
+
+    Every chunk is appended as one batch per node with one manifest write,
+    so only one chunk of the run is in memory at a time.
+
+    Args:
+        node_ids: the node ids, in the order of the columns of the chunks
+        chunks: log times and the values, one row per log time and one column per node
+    """
+    store = SegmentStore(root=out_dir)
+    store.clear(run_id)
+
+    chunks = iter(chunks)
+    chunk = next(chunks, None)
+    seq = 0
+    while chunk is not None:
+        following = next(chunks, None)  # the batches of the last chunk are marked last
+        times, values = chunk
+        columns = np.ascontiguousarray(values.T)
+
+        store.append_many(
+            run_id,
+            (
+                (node_id, seq, times, columns[c], following is None, resolution)
+                for c, node_id in enumerate(node_ids)
+            ),
+            sync=False,
+        )
+        chunk = following
+        seq += 1
+
+    export_run(store, run_id, csv_dir)
+
+
+def export_run(store: SegmentStore, run_id: str, csv_dir: str = None) -> None:
+    if csv_dir is not None:
+        os.makedirs(csv_dir, exist_ok=True)
+        store.export_csv(run_id, os.path.join(csv_dir, f"{run_id}.csv"))
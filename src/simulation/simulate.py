@@ -0,0 +1,272 @@
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import sys
+from argparse import ArgumentParser
+from configparser import ConfigParser
+from random import choice, seed, uniform
+from time import time as wall_time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# the synchronisation modules and the history of the nodes
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "node"))
+
+from history import History
+from runs import read_config, store_run
+from synchronisation import bsrg, clock, kuramoto, metrohasting
+from synchronisation.interface import Reply, Synchronisation_Interface
+from virtual_time import VirtualTimeLoop
+
+MODELS = {
+    "kuramoto": kuramoto.KuramotoModell,
+    "clock": clock.Clock,
+    "metropolis": metrohasting.MetroHasting,
+    "mypotts": bsrg.BSRG,
+}
+
+
+def init_argparse() -> ArgumentParser:
+    parser = ArgumentParser(
+        usage="%(prog)s [OPTION] config.ini ...",
+        description="simulate runs of .ini files in one process on a virtual clock",
+    )
+    parser.add_argument("configs", nargs="+")
+    parser.add_argument("-o", "--out_dir", default="./runs/")
+    parser.add_argument("-c", "--csv_dir")  # also export the wide csv of every run
+    parser.add_argument("-l", "--latency", type=float, default=0.002)
+    parser.add_argument("-s", "--seed", type=int)
+    parser.add_argument("-p", "--processes", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")  # show output of the models
+
+    return parser
+
+
+class SimNetwork:
+    """Delivers messages between the simulated nodes after a random latency"""
+
+    def __init__(self, latency: float = 0.002):
+        self.latency = latency
+        self.nodes: Dict[int, "SimNode"] = {}
+        self.background_tasks = set()
+
+    def delay(self) -> float:
+        return self.latency * uniform(0.5, 1.5)
+
+    def send(self, to: int, msg: dict, reply: Reply = None) -> None:
+        # copy like a serialisation would, so sender and receiver never share a dict
+        asyncio.get_running_loop().call_later(
+            self.delay(), self.deliver, to, dict(msg), reply
+        )
+
+    def deliver(self, to: int, msg: dict, reply: Reply) -> None:
+        task = asyncio.create_task(self.nodes[to].handle_message(msg, reply))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+
+class SimReply(Reply):
+    """Answers a request by resolving the future of the requesting node after the latency"""
+
+    def __init__(self, network: SimNetwork, future: asyncio.Future):
+        self.network = network
+        self.future = future
+
+    async def send(self, msg: dict) -> None:
+        asyncio.get_running_loop().call_later(
+            self.network.delay(), self.resolve, dict(msg)
+        )
+
+    def resolve(self, msg: dict) -> None:
+        if not self.future.done():
+            self.future.set_result(msg)
+
+
+class SimNode:
+    """Stands in for node.Node: the synchronisation modules see the same attributes and functions,
+    but messages go through the SimNetwork instead of TCP connections."""
+
+    def __init__(self, network: SimNetwork):
+        self.network = network
+        self.id: int = None
+        self.neighbors: list[int] = None
+        self.synchronization_module: Synchronisation_Interface = None
+        self.degree: int = None
+        self.history: History = History()
+
+        self.logs_sent: asyncio.Event = asyncio.Event()
+
+    def register_new_node_config(self, msg: dict) -> None:
+        self.id = int(msg["node_id"])
+        self.neighbors = [int(id) for id in msg["neighbors"].split("-")]
+        self.degree = len(self.neighbors)
+        try:
+            self.history = History(capacity=int(msg["history_capacity"]))
+        except KeyError:
+            self.history = History()
+
+    def register_synchronisation_modell(self, msg: dict) -> None:
+        self.synchronization_module = MODELS[msg["synchronization_model"]](self)
+        self.synchronization_module.register_new_config(msg=msg)
+
+    def get_neighbors(self) -> list[int]:
+        return self.neighbors
+
+    def get_random_neighbor(self) -> int:
+        return choice(self.neighbors)
+
+    async def send_logs(self) -> None:
+        self.logs_sent.set()
+
+    async def request_random_neighbor(self, msg: dict) -> Tuple[int, dict]:
+        neighborid: int = self.get_random_neighbor()
+
+        future = asyncio.get_running_loop().create_future()
+        self.network.send(neighborid, msg, SimReply(self.network, future))
+        return neighborid, await future
+
+    async def send_message_to_all_neighbors(
+        self, msg: dict, neighbors: list[int] = None
+    ) -> None:
+        if neighbors is None:
+            neighbors = self.neighbors
+
+        for id in neighbors:
+            self.network.send(id, msg)
+
+    async def handle_message(self, msg: dict, reply: Reply = None) -> None:
+        if msg["type"] == "node":
+            if msg["operation"] == "config":
+                self.register_new_node_config(msg)
+                self.register_synchronisation_modell(msg)
+        elif msg["type"] == "synchronization" and self.synchronization_module:
+            await self.synchronization_module.handle(msg=msg, reply=reply)
+
+
+async def simulate(
+    config: ConfigParser, run_id: str, latency: float = 0.002
+) -> Dict[int, History]:
+    """Run the config like the controller does: config, share state, start.
+
+    Returns:
+        the history of every node once all nodes sent their logs
+    """
+    network = SimNetwork(latency=latency)
+    node_ids = [int(n) for n in config.sections()]
+    model: str = config[config.sections()[0]]["synchronization_model"]
+
+    for node_id in node_ids:
+        network.nodes[node_id] = SimNode(network)
+
+    for node_id in node_ids:
+        msg = {"type": "node", "operation": "config", "run": run_id}
+        msg.update({k: v for k, v in config[str(node_id)].items() if k != "graph"})
+        await network.nodes[node_id].handle_message(msg)
+
+    # same pauses as controller/control.py
+    if model in ["mypotts", "metropolis"]:
+        await asyncio.sleep(2)
+        for node_id in node_ids:
+            network.send(
+                node_id, {"type": "synchronization", "operation": "share_state"}
+            )
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(5)
+    else:
+        await asyncio.sleep(2)
+
+    for node_id in node_ids:
+        network.send(node_id, {"type": "synchronization", "operation": "start"})
+
+    await asyncio.gather(*(n.logs_sent.wait() for n in network.nodes.values()))
+
+    return {node_id: network.nodes[node_id].history for node_id in node_ids}
+
+
+async def cancel_leftovers() -> None:
+    """cancel the tasks of the models that still wait, e.g. for the end of the run"""
+    leftovers = asyncio.all_tasks() - {asyncio.current_task()}
+    for task in leftovers:
+        task.cancel()
+    await asyncio.gather(*leftovers, return_exceptions=True)
+
+
+def run_simulation(
+    config_file: str,
+    out_dir: str = "./runs/",
+    csv_dir: str = None,
+    latency: float = 0.002,
+    random_seed: int = None,
+    verbose: bool = False,
+) -> str:
+    """Simulate the run of an .ini file and store the histories like the logstorage does
+
+    Returns:
+        the run id
+    """
+    start = wall_time()
+
+    config, run_id = read_config(config_file)
+
+    if random_seed is not None:
+        seed(random_seed)
+
+    loop = VirtualTimeLoop()
+    # the models read the virtual clock instead of time.time
+    for module in (kuramoto, clock, metrohasting, bsrg):
+        module.time = loop.time
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+        sys.stdout if verbose else devnull
+    ):
+        try:
+            histories = loop.run_until_complete(simulate(config, run_id, latency))
+            loop.run_until_complete(cancel_leftovers())
+        finally:
+            loop.close()
+
+    columns = []
+    for node_id, history in histories.items():
+        times, values, _ = history.since(0)
+        columns.append(
+            (
+                node_id,
+                np.frombuffer(times, dtype="d"),
+                np.frombuffer(values, dtype="d"),
+            )
+        )
+    store_run(run_id, columns, out_dir=out_dir, csv_dir=csv_dir)
+
+    print(f"{run_id}: simulated {loop.now:.1f} s in {wall_time() - start:.1f} s")
+    return run_id
+
+
+def main():
+    parser = init_argparse()
+    args = parser.parse_args()
+
+    arguments: List[tuple] = [
+        (
+            config_file,
+            args.out_dir,
+            args.csv_dir,
+            args.latency,
+            None if args.seed is None else args.seed + i,
+            args.verbose,
+        )
+        for i, config_file in enumerate(args.configs)
+    ]
+
+    if args.processes == 1:
+        for a in arguments:
+            run_simulation(*a)
+        return
+
+    with multiprocessing.Pool(processes=args.processes) as pool:
+        pool.starmap(run_simulation, arguments)
+
+
+if __name__ == "__main__":
+    main()
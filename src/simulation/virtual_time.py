@@ -0,0 +1,41 @@
+import asyncio
+import selectors
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """Selector that never blocks: instead of waiting for the next timer it moves the clock to it"""
+
+    def __init__(self, loop: "VirtualTimeLoop"):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout: float = None):
+        ready = super().select(0)
+        if ready:
+            return ready
+
+        if timeout is None:
+            # no timer left and nothing ready: every task waits for something that never happens
+            raise RuntimeError("simulation stalled: no scheduled events left")
+
+        self.loop.now += max(timeout, 0)
+        return []
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop running on a virtual clock.
+
+    asyncio keeps its timers (asyncio.sleep, call_later) in a heap ordered by time,
+    so the loop already is a priority queue event scheduler: once all ready callbacks ran,
+    the selector jumps the clock to the earliest timer instead of sleeping until it is due.
+    A simulated minute takes as long as the callbacks in it need to run.
+
+    Code that reads the time has to use loop.time(), see simulate.py for the models.
+    """
+
+    def __init__(self, start: float = 0):
+        self.now: float = start
+        super().__init__(VirtualSelector(self))
+
+    def time(self) -> float:
+        return self.now